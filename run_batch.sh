@@ -21,6 +21,15 @@ THRESHOLD_TO_EXCLUDE_BASE_ON_PUPIL=2 # Threshold for excluding events based on p
 PLOT_TRACES=true # Whether to generate plots of the traces
 SAVE_TRACE_PLOT=true # Whether to save the generated trace plots
 CLEAR_OUTPUT=false # Whether to clear output after processing (useful in interactive environments)
+WORKERS=1 # Number of folders to process in parallel
+SKIP_UNCHANGED=false # Whether to skip folders whose inputs and parameters match their result manifest
+USE_CACHE=false # Whether to cache parsed CSV columns as binary files next to the data
+MEMO=false # Whether to reuse stage results across folders with identical inputs within each worker
+PROFILE=false # Whether to record per-stage timing and memory and write a profile report
+SAVE_CSV=true # Whether to write the per-modality CSV files next to the results store
+STORE_FORMAT=npz # Format of the per-folder results store: npz, hdf5 (needs h5py) or none
+WHISKER_RATE= # Sampling rate of the resampled whisker trace; empty spreads it over 900 s
+CHUNK_ROWS= # Process out of core, reading this many samples at a time (e.g. 500000 for multi-hour sessions); empty loads whole traces
 
 # Run init.sh to set up the environment
 source ./init.sh
@@ -30,7 +39,10 @@ usage() {
     echo "Usage: $0 [-r <root_folder>] [--folders <folder1 folder2 ...>] --default_result_path <path>"
     echo "          [--threshold_min_max <value>] [--threshold_pupil <value>]"
     echo "          [--plot_traces <true|false>] [--save_trace_plot <true|false>] [--clear_output <true|false>]"
-    echo "          [--bsline_length <value>] [--event_length <value>]"
+    echo "          [--bsline_length <value>] [--event_length <value>] [--workers <value>]"
+    echo "          [--skip_unchanged <true|false>] [--use_cache <true|false>] [--memo <true|false>] [--profile <true|false>]"
+    echo "          [--save_csv <true|false>] [--store_format <npz|hdf5|none>]"
+    echo "          [--whisker_rate <value>] [--chunk_rows <value>]"
     exit 1
 }
 
@@ -47,6 +59,15 @@ while [[ "$#" -gt 0 ]]; do
         --clear_output) CLEAR_OUTPUT="$2"; shift ;;
         --bsline_length) BSLINE_LENGTH="$2"; shift ;;
         --event_length) EVENT_LENGTH="$2"; shift ;;
+        --workers) WORKERS="$2"; shift ;;
+        --skip_unchanged) SKIP_UNCHANGED="$2"; shift ;;
+        --use_cache) USE_CACHE="$2"; shift ;;
+        --memo) MEMO="$2"; shift ;;
+        --profile) PROFILE="$2"; shift ;;
+        --save_csv) SAVE_CSV="$2"; shift ;;
+        --store_format) STORE_FORMAT="$2"; shift ;;
+        --whisker_rate) WHISKER_RATE="$2"; shift ;;
+        --chunk_rows) CHUNK_ROWS="$2"; shift ;;
         *) usage ;;
     esac
     shift
@@ -64,6 +85,30 @@ if [ -z "$ROOT_FOLDER" ] && [ ${#LIST_OF_FOLDERS[@]} -eq 0 ]; then
     usage
 fi
 
+EXTRA_ARGS=()
+if [ "$SKIP_UNCHANGED" = true ]; then
+    EXTRA_ARGS+=(--skip_unchanged)
+fi
+if [ "$USE_CACHE" = true ]; then
+    EXTRA_ARGS+=(--use_cache)
+fi
+if [ "$MEMO" = true ]; then
+    EXTRA_ARGS+=(--memo)
+fi
+if [ "$PROFILE" = true ]; then
+    EXTRA_ARGS+=(--profile)
+fi
+if [ "$SAVE_CSV" = false ]; then
+    EXTRA_ARGS+=(--no_csv)
+fi
+EXTRA_ARGS+=(--store_format "$STORE_FORMAT")
+if [ -n "$WHISKER_RATE" ]; then
+    EXTRA_ARGS+=(--whisker_rate "$WHISKER_RATE")
+fi
+if [ -n "$CHUNK_ROWS" ]; then
+    EXTRA_ARGS+=(--chunk_rows "$CHUNK_ROWS")
+fi
+
 # Run the Python script with the provided arguments
 if [ -n "$ROOT_FOLDER" ]; then
     python scripts/run_batch.py --root_folder "$ROOT_FOLDER" --default_result_path "$DEFAULT_RESULT_PATH" \
@@ -73,7 +118,9 @@ if [ -n "$ROOT_FOLDER" ]; then
         --save_trace_plot "$SAVE_TRACE_PLOT" \
         --clear_output "$CLEAR_OUTPUT" \
         --bsline_length "$BSLINE_LENGTH" \
-        --event_length "$EVENT_LENGTH"
+        --event_length "$EVENT_LENGTH" \
+        --workers "$WORKERS" \
+        "${EXTRA_ARGS[@]}"
 elif [ ${#LIST_OF_FOLDERS[@]} -gt 0 ]; then
     python scripts/run_batch.py --folders "${LIST_OF_FOLDERS[@]}" --default_result_path "$DEFAULT_RESULT_PATH" \
         --threshold_to_exclude_from_min_max "$THRESHOLD_TO_EXCLUDE_FROM_MIN_MAX" \
@@ -82,5 +129,7 @@ elif [ ${#LIST_OF_FOLDERS[@]} -gt 0 ]; then
         --save_trace_plot "$SAVE_TRACE_PLOT" \
         --clear_output "$CLEAR_OUTPUT" \
         --bsline_length "$BSLINE_LENGTH" \
-        --event_length "$EVENT_LENGTH"
+        --event_length "$EVENT_LENGTH" \
+        --workers "$WORKERS" \
+        "${EXTRA_ARGS[@]}"
 fi
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+import sys
+import argparse
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+
+from src.utils.aggregation import GROUP_BY, aggregate_results, aggregate_frame
+from src.utils.results_store import MODALITIES
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Average event windows across all processed cycles below a results root.')
+    parser.add_argument('results_root', type=str, help='Root folder of the processing results, e.g. the batch default_result_path')
+    parser.add_argument('--group_by', type=str, default='all', choices=GROUP_BY, help='Pool all cycles, or group them by date folder or by cycle')
+    parser.add_argument('--modalities', nargs='+', default=list(MODALITIES), choices=list(MODALITIES), help='Modalities to aggregate')
+    parser.add_argument('--output', type=str, default='aggregate_results.csv', help='CSV file for the tidy mean/variance table')
+
+    args = parser.parse_args()
+
+    stats = aggregate_results(args.results_root, args.group_by, args.modalities)
+    aggregate_frame(stats).to_csv(args.output, index=False)
+    for (group, modality), running in stats.items():
+        print(f"{group:<24}  {modality:<10}  {running.n_cycles:>4} cycles  {int(running.count.max()):>6} events")
+    print(f"Aggregate written to {args.output}")
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+
+import numpy as np
+from src.data.synthetic import write_synthetic_cycle
+from src.utils.data_processing import process_data
+from src.utils.event_detection import detect_events
+from src.utils.processing import process_pupil_data, process_calcium_data, process_arteriole_data, process_whisker_data
+from src.utils.stages import compute_stages
+from src.utils.utilities import (
+    detect_and_interpolate_sudden_changes, normalize_mean_std, detect_sudden_change_events,
+    build_event_mask, fill_false_between_trues, find_consecutive_true_blocks,
+)
+
+# 15 min, 1 h and 8 h traces
+DEFAULT_DURATIONS = [900, 3600, 28800]
+DEFAULT_OUTPUT_DIR = os.path.join(PROJECT_ROOT, 'benchmarks')
+DEFAULT_DATA_DIR = os.path.join(PROJECT_ROOT, '.cache', 'benchmarks')
+
+def git_commit():
+    try:
+        completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=PROJECT_ROOT)
+    except OSError:
+        return None
+    return completed.stdout.strip() or None
+
+def time_call(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return {'best': min(timings), 'median': float(np.median(timings)), 'repeats': repeats}
+
+def synthetic_cycle(data_dir, duration, seed):
+    # Generated once per (duration, seed) and reused by later runs
+    data_folder = os.path.join(data_dir, f'{duration}s_seed{seed}')
+    if not os.path.exists(os.path.join(data_folder, 'synthetic.json')):
+        write_synthetic_cycle(data_folder, duration=duration, seed=seed)
+    return data_folder
+
+def benchmark_cycle(data_folder, repeats):
+    stages = compute_stages(data_folder, memo=False)
+    pupil_sampling_rate, whisker_sampling_rate = stages['pupil_sampling_rate'], stages['whisker_sampling_rate']
+    pre_event_window, event_window = 5 * pupil_sampling_rate, 15 * pupil_sampling_rate
+    signal = stages['normalized_smoothed_pupil_size']
+    smoothed_time_series = stages['smoothed_time_series']
+    pupil_data_normalized = normalize_mean_std(stages['pupil_data'].copy())
+
+    _, event_indices = detect_sudden_change_events(signal, 5, pre_event_window, event_window, 3, 1)
+    mask = build_event_mask(event_indices, signal.shape[0], pre_event_window + event_window) > 0.5
+    filled_mask = fill_false_between_trues(mask, 10 * pupil_sampling_rate)
+    events = stages['waking_up_events']
+
+    cases = {
+        'detect_and_interpolate_sudden_changes': lambda: detect_and_interpolate_sudden_changes(pupil_data_normalized, 0.001, 1),
+        'detect_sudden_change_events': lambda: detect_sudden_change_events(signal, 5, pre_event_window, event_window, 3, 1),
+        'build_event_mask': lambda: build_event_mask(event_indices, signal.shape[0], pre_event_window + event_window),
+        'fill_false_between_trues': lambda: fill_false_between_trues(mask, 10 * pupil_sampling_rate),
+        'find_consecutive_true_blocks': lambda: find_consecutive_true_blocks(filled_mask, pupil_sampling_rate),
+        'detect_events': lambda: detect_events(signal, smoothed_time_series, stages['normalized_whisker_velocity'], stages['whisker_velocity_time'],
+                                               pupil_sampling_rate, whisker_sampling_rate, 5, 15),
+        'process_pupil_data': lambda: process_pupil_data(stages['pupil_size_normalized'], stages['pupil_time'], smoothed_time_series, events, None,
+                                                         pupil_sampling_rate, exclude_threshold=2, save_files=False, normalize=False),
+        'process_calcium_data': lambda: process_calcium_data(stages['calcium_data'], smoothed_time_series, events, None, stages['calcium_sampling_rate'], save_files=False),
+        'process_arteriole_data': lambda: process_arteriole_data(stages['arteriole_data'], smoothed_time_series, events, None, stages['arteriole_sampling_rate'], save_files=False),
+        'process_whisker_data': lambda: process_whisker_data(stages['normalized_whisker_velocity'], stages['whisker_velocity_time'], smoothed_time_series, events, None,
+                                                             whisker_sampling_rate, save_files=False),
+    }
+    results = {name: time_call(function, repeats) for name, function in cases.items()}
+
+    results_folder = tempfile.mkdtemp(prefix='benchmark_results_')
+    try:
+        results['process_data'] = time_call(lambda: process_data(data_folder, results_folder=results_folder, save_trace_plot=False,
+                                                                 clear_output=False, memo=False), repeats)
+    finally:
+        shutil.rmtree(results_folder, ignore_errors=True)
+
+    return {'n_pupil_samples': int(stages['pupil_data'].shape[0]), 'n_whisker_samples': int(stages['whisker_angle'].shape[0]),
+            'n_events': int(len(events)), 'timings': results}
+
+def run_benchmarks(durations=DEFAULT_DURATIONS, repeats=3, data_dir=DEFAULT_DATA_DIR, seed=0):
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'seed': seed,
+        'durations': {},
+    }
+    for duration in durations:
+        print(f"Benchmarking a {duration} s synthetic cycle", flush=True)
+        report['durations'][str(duration)] = benchmark_cycle(synthetic_cycle(data_dir, duration, seed), repeats)
+    return report
+
+def format_report(report, baseline=None):
+    lines = []
+    for duration, result in report['durations'].items():
+        lines.append(f"{duration} s trace: {result['n_pupil_samples']} pupil samples, {result['n_events']} events")
+        header = f"  {'Function':<40}  {'Best (s)':>9}  {'Median (s)':>10}"
+        if baseline is not None:
+            header += f"  {'Baseline (s)':>12}  {'Speedup':>7}"
+        lines.append(header)
+        for name, timing in result['timings'].items():
+            line = f"  {name:<40}  {timing['best']:>9.4f}  {timing['median']:>10.4f}"
+            baseline_timing = (baseline or {}).get('durations', {}).get(duration, {}).get('timings', {}).get(name)
+            if baseline_timing is not None:
+                line += f"  {baseline_timing['best']:>12.4f}  {baseline_timing['best'] / timing['best']:>6.2f}x"
+            lines.append(line)
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the hot functions and process_data on synthetic cycles of several lengths.')
+    parser.add_argument('--durations', type=int, nargs='+', default=DEFAULT_DURATIONS, help='Trace lengths in seconds')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed calls per function, the best and median are kept')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic generator')
+    parser.add_argument('--data_dir', type=str, default=DEFAULT_DATA_DIR, help='Where synthetic cycles are generated and reused')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR, help='Where the JSON report is written')
+    parser.add_argument('--compare', type=str, help='Earlier JSON report to compute speedups against')
+
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    report = run_benchmarks(args.durations, args.repeats, args.data_dir, args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(args.output_dir, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['commit'] or 'nogit'}.json")
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+    print(f"Report written to {output_file}")
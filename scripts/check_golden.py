@@ -0,0 +1,36 @@
+import os
+import sys
+import logging
+import argparse
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+
+from src.utils.golden import GOLDEN_CASES, DETECTORS, DEFAULT_RTOL, DEFAULT_ATOL, GOLDEN_DIR, check_case
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare detected events and window matrices against the golden snapshots.')
+    parser.add_argument('--cases', nargs='+', default=list(GOLDEN_CASES), choices=list(GOLDEN_CASES), help='Cases to check')
+    parser.add_argument('--detector', type=str, default='event_detection', choices=list(DETECTORS), help='Implementation under test')
+    parser.add_argument('--reference', type=str, default='reference', choices=list(DETECTORS), help='Implementation the speedup is measured against')
+    parser.add_argument('--no_reference', action='store_true', help='Skip timing the reference implementation')
+    parser.add_argument('--update', action='store_true', help='Rewrite the snapshots from the detector instead of comparing, the bundled ones come from the original loop pipeline')
+    parser.add_argument('--rtol', type=float, default=DEFAULT_RTOL, help='Relative tolerance of the window matrices')
+    parser.add_argument('--atol', type=float, default=DEFAULT_ATOL, help='Absolute tolerance of the window matrices')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed detector calls per case, the best run is kept')
+    parser.add_argument('--golden_dir', type=str, default=GOLDEN_DIR, help='Directory holding the <case>.npz snapshots')
+
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    failed = False
+    print(f"{'Case':<18}  {'Status':<8}  {'Events':>6}  {'Detect (s)':>10}  {'Reference (s)':>13}  {'Speedup':>7}")
+    for case in args.cases:
+        result = check_case(case, args.detector, None if args.no_reference else args.reference, args.update,
+                            args.rtol, args.atol, args.repeats, args.golden_dir)
+        print(f"{case:<18}  {result['status']:<8}  {result['n_events']:>6}  {result['detect_time']:>10.4f}  "
+              f"{result['reference_time']:>13.4f}  {result['speedup']:>6.1f}x")
+        for difference in result['differences']:
+            print(f"    {difference}")
+        failed |= result['status'] in ('fail', 'missing', 'error')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,65 @@
+import os
+import sys
+import argparse
+import subprocess
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Entry-point modules and the budget for their cumulative import time
+DEFAULT_MODULES = ['src.utils.data_processing', 'src.utils.event_detection', 'src.utils.utilities', 'src.data.data_loader']
+DEFAULT_BUDGET_MS = 1000
+
+# Interactive and plotting packages that headless imports must not pull in
+FORBIDDEN_MODULES = ['matplotlib.pyplot', 'ipywidgets', 'IPython', 'scipy.signal']
+
+def measure_import(module, python=sys.executable):
+    # Returns (cumulative microseconds for module, set of modules imported) from one fresh interpreter
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PROJECT_ROOT, os.environ.get('PYTHONPATH', '')]))
+    completed = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True, env=env, cwd=PROJECT_ROOT)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr}")
+
+    cumulative_us = None
+    imported = set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative_us = int(cumulative)
+    return cumulative_us, imported
+
+def check_import_time(modules=DEFAULT_MODULES, budget_ms=DEFAULT_BUDGET_MS, repeats=5):
+    failures = []
+    print(f"{'Module':<32}  {'Best (ms)':>9}  {'Budget (ms)':>11}  Forbidden imports")
+    for module in modules:
+        timings = []
+        imported = set()
+        for _ in range(repeats):
+            cumulative_us, imported = measure_import(module)
+            timings.append(cumulative_us / 1000)
+        best_ms = min(timings)
+        forbidden = [name for name in FORBIDDEN_MODULES if name in imported]
+        print(f"{module:<32}  {best_ms:>9.1f}  {budget_ms:>11.0f}  {', '.join(forbidden) or '-'}")
+
+        if best_ms > budget_ms:
+            failures.append(f"{module} took {best_ms:.1f} ms, budget is {budget_ms} ms")
+        if forbidden:
+            failures.append(f"{module} imports {', '.join(forbidden)}")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Guard the import time of the headless entry points with python -X importtime.')
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help='Modules to import')
+    parser.add_argument('--budget_ms', type=float, default=DEFAULT_BUDGET_MS, help='Maximum cumulative import time per module')
+    parser.add_argument('--repeats', type=int, default=5, help='Fresh interpreters per module, the best run is kept')
+
+    args = parser.parse_args()
+
+    failures = check_import_time(args.modules, args.budget_ms, args.repeats)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
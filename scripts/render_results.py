@@ -0,0 +1,23 @@
+import os
+import sys
+import argparse
+import matplotlib
+
+# Add the project root to the PYTHONPATH
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render figures from saved processing results.')
+    parser.add_argument('results_folders', nargs='+', help='Results folders written by process_data')
+    parser.add_argument('--show', action='store_true', help='Show figures instead of only saving them')
+    parser.add_argument('--no_save', action='store_true', help='Do not write PNG files')
+
+    args = parser.parse_args()
+    if not args.show:
+        # Nothing is displayed, render off-screen
+        matplotlib.use('Agg')
+    from src.visualization.traces import render_results
+
+    for results_folder in args.results_folders:
+        rendered = render_results(results_folder, show=args.show, save=not args.no_save)
+        print(f"{results_folder}: rendered {', '.join(rendered) if rendered else 'nothing'}")
@@ -0,0 +1,23 @@
+import os
+import sys
+import argparse
+from src.utils.streaming import replay_recording
+
+# Add the project root to the PYTHONPATH
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay recorded cycles through the streaming event detector.')
+    parser.add_argument('data_folders', nargs='+', help='Cycle folders containing the acquisition CSVs')
+    parser.add_argument('--chunk_seconds', type=float, default=1.0, help='Duration of each pushed chunk')
+    parser.add_argument('--no_calibration', action='store_true', help='Use streaming percentile estimates instead of calibrating on the recording')
+    parser.add_argument('--bsline_length', type=int, default=5, help='Baseline length in seconds')
+    parser.add_argument('--event_length', type=int, default=15, help='Event length in seconds')
+
+    args = parser.parse_args()
+
+    for data_folder in args.data_folders:
+        events = replay_recording(data_folder, args.chunk_seconds, not args.no_calibration, args.bsline_length, args.event_length)
+        print(f"{data_folder}: {len(events)} events")
+        for event in events:
+            print(f"  index {event['index']:>6}  time {event['time']:>8.2f} s  integral ratio {event['integral_ratio']:.2f}")
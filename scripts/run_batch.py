@@ -1,10 +1,15 @@
 import os
 import sys
 import logging
+import time
 import argparse
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from src.utils.data_processing import process_data
 from src.utils.utilities import find_folders_with_csv
+from src.utils.manifest import is_unchanged, write_manifest
+from src.utils.profiling import load_profiles, format_profile_report
 
 # Add the project root to the PYTHONPATH
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -18,10 +23,92 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+def results_folder_for(folder, default_result_path):
+    # Construct the results folder path
+    base_folder = os.path.join(*folder.split(os.sep)[-2:])  # This will give "2023.06.01/cycle_8"
+    return os.path.join(default_result_path, base_folder)
+
+def process_folder(folder, default_result_path, process_kwargs, skip_unchanged=False):
+    start_time = time.perf_counter()
+    results_folder = results_folder_for(folder, default_result_path)
+    try:
+        if skip_unchanged and is_unchanged(folder, results_folder, process_kwargs):
+            logging.info(f"Skipping unchanged folder: {folder}")
+            return {'folder': folder, 'results_folder': results_folder, 'status': 'skipped',
+                    'wall_time': time.perf_counter() - start_time, 'error': None}
+
+        logging.info(f"Processing folder: {folder}")
+        logging.info(f"Results folder: {results_folder}")
+
+        # Ensure the results directory exists
+        os.makedirs(results_folder, exist_ok=True)
+
+        process_data(folder, results_folder=results_folder, **process_kwargs)
+        write_manifest(results_folder, folder, process_kwargs)
+        logging.info(f"Successfully processed folder: {folder}")
+        status, error = 'ok', None
+    except Exception as e:
+        logging.error(f"Error processing folder {folder}: {e}")
+        status, error = 'failed', str(e)
+
+    return {'folder': folder, 'results_folder': results_folder, 'status': status,
+            'wall_time': time.perf_counter() - start_time, 'error': error}
+
+def init_worker(batch_log_file):
+    # Each worker renders off-screen and logs to its own file
+    import matplotlib
+    matplotlib.use('Agg')
+
+    root, ext = os.path.splitext(batch_log_file)
+    handler = logging.FileHandler(f'{root}_worker_{os.getpid()}{ext}')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger = logging.getLogger()
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+def run_folders_in_pool(folders, default_result_path, process_kwargs, workers, skip_unchanged=False):
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(log_file,)) as executor:
+        futures = {executor.submit(process_folder, folder, default_result_path, process_kwargs, skip_unchanged): folder for folder in folders}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker itself died, e.g. killed for memory
+                logging.error(f"Worker failed while processing folder {folder}: {e}")
+                result = {'folder': folder, 'results_folder': results_folder_for(folder, default_result_path),
+                          'status': 'failed', 'wall_time': float('nan'), 'error': str(e)}
+            logging.info(f"Finished folder {folder} with status {result['status']}")
+            results.append(result)
+
+    order = {folder: idx for idx, folder in enumerate(folders)}
+    return sorted(results, key=lambda result: order[result['folder']])
+
+def format_summary(results):
+    folder_width = max([len('Folder')] + [len(result['folder']) for result in results])
+    lines = [f"{'Folder':<{folder_width}}  {'Status':<7}  {'Wall time (s)':>13}"]
+    lines.append('-' * len(lines[0]))
+    for result in results:
+        lines.append(f"{result['folder']:<{folder_width}}  {result['status']:<7}  {result['wall_time']:>13.2f}")
+    n_failed = sum(result['status'] == 'failed' for result in results)
+    n_skipped = sum(result['status'] == 'skipped' for result in results)
+    lines.append(f"{len(results) - n_failed - n_skipped} succeeded, {n_skipped} skipped, {n_failed} failed")
+    return '\n'.join(lines)
+
+def write_profile_report(results, report_file):
+    # Collects the profile.json of every processed folder into one tidy CSV and a printed report
+    profiles = load_profiles([result['results_folder'] for result in results if result['status'] == 'ok'])
+    profiles.to_csv(report_file, index=False)
+    return format_profile_report(profiles)
+
 def run_batch(root_folder=None, list_of_folders=None, default_result_path=None,
               threshold_to_exclude_from_min_max=1, threshold_to_exclude_base_on_pupil=2,
               plot_traces=True, save_trace_plot=True, clear_output=False,
-              bsline_length=5, event_length=15):
+              bsline_length=5, event_length=15, workers=1, skip_unchanged=False, use_cache=False, memo=False, profile=False,
+              save_csv=True, store_format='npz', float_rates=False, whisker_rate=None, chunk_rows=None):
     try:
         logging.info("Starting batch data processing")
 
@@ -35,36 +122,41 @@ def run_batch(root_folder=None, list_of_folders=None, default_result_path=None,
         if not default_result_path:
             raise ValueError("default_result_path must be provided")
 
-        for folder in folders:
-            try:
-                logging.info(f"Processing folder: {folder}")
-
-                # Construct the results folder path
-                base_folder = os.path.join(*folder.split(os.sep)[-2:])  # This will give "2023.06.01/cycle_8"
-                print("Basefolder ", base_folder)
-                logging.info(f"Basefolder: {base_folder}")
-                results_folder = os.path.join(default_result_path, base_folder)
-                logging.info(f"Results folder: {results_folder}")
-
-                # Ensure the results directory exists
-                os.makedirs(results_folder, exist_ok=True)
-
-                process_data(
-                    folder,
-                    threshold_to_exclude_from_min_max=threshold_to_exclude_from_min_max,
-                    threshold_to_exclude_base_on_pupil=threshold_to_exclude_base_on_pupil,
-                    plot_traces=plot_traces,
-                    save_trace_plot=save_trace_plot,
-                    clear_output=clear_output,
-                    bsline_length=bsline_length,
-                    event_length=event_length,
-                    results_folder=results_folder
-                )
-                logging.info(f"Successfully processed folder: {folder}")
-            except Exception as e:
-                logging.error(f"Error processing folder {folder}: {e}")
+        process_kwargs = dict(
+            threshold_to_exclude_from_min_max=threshold_to_exclude_from_min_max,
+            threshold_to_exclude_base_on_pupil=threshold_to_exclude_base_on_pupil,
+            plot_traces=plot_traces,
+            save_trace_plot=save_trace_plot,
+            clear_output=clear_output,
+            bsline_length=bsline_length,
+            event_length=event_length,
+            use_cache=use_cache,
+            memo=memo,
+            profile=profile,
+            save_csv=save_csv,
+            store_format=store_format,
+            float_rates=float_rates,
+            whisker_rate=whisker_rate,
+            chunk_rows=chunk_rows,
+        )
+
+        if workers > 1:
+            logging.info(f"Processing {len(folders)} folders with {workers} workers")
+            results = run_folders_in_pool(folders, default_result_path, process_kwargs, workers, skip_unchanged)
+        else:
+            results = [process_folder(folder, default_result_path, process_kwargs, skip_unchanged) for folder in folders]
+
+        summary = format_summary(results)
+        print(summary)
+        logging.info(f"Batch summary:\n{summary}")
 
+        if profile:
+            report_file = f'{os.path.splitext(log_file)[0]}_profile.csv'
+            report = write_profile_report(results, report_file)
+            print(report)
+            logging.info(f"Stage profile (per-cycle records in {report_file}):\n{report}")
         logging.info("Batch data processing completed")
+        return results
 
     except Exception as e:
         logging.error(f"An error occurred during batch processing: {e}")
@@ -82,8 +174,20 @@ if __name__ == "__main__":
     parser.add_argument('--clear_output', type=bool, default=False, help='Whether to clear output')
     parser.add_argument('--bsline_length', type=int, default=5, help='Baseline length')
     parser.add_argument('--event_length', type=int, default=15, help='Event length')
+    parser.add_argument('--use_cache', action='store_true', help='Cache parsed CSV columns as binary files next to the data')
+    parser.add_argument('--memo', action='store_true', help='Reuse stage results across folders with identical inputs within each worker')
+    parser.add_argument('--workers', type=int, default=1, help='Number of folders to process in parallel')
+    parser.add_argument('--skip_unchanged', action='store_true', help='Skip folders whose inputs and parameters match their result manifest')
+    parser.add_argument('--profile', action='store_true', help='Record per-stage timing and memory and report it across folders')
+    parser.add_argument('--no_csv', action='store_true', help='Do not write the per-modality CSV files')
+    parser.add_argument('--float_rates', action='store_true', help='Size event windows from the measured median sampling rates')
+    parser.add_argument('--whisker_rate', type=float, default=None, help='Sampling rate of the resampled whisker trace, by default it spans 900 s')
+    parser.add_argument('--chunk_rows', type=int, default=None, help='Process out of core, reading the CSVs this many samples at a time')
+    parser.add_argument('--store_format', type=str, default='npz', choices=['npz', 'hdf5', 'none'], help='Format of the per-folder results store')
 
     args = parser.parse_args()
+    # Scripted runs save their figures without displaying them
+    matplotlib.use('Agg')
 
     run_batch(
         root_folder=args.root_folder,
@@ -95,5 +199,15 @@ if __name__ == "__main__":
         save_trace_plot=args.save_trace_plot,
         clear_output=args.clear_output,
         bsline_length=args.bsline_length,
-        event_length=args.event_length
+        event_length=args.event_length,
+        workers=args.workers,
+        skip_unchanged=args.skip_unchanged,
+        use_cache=args.use_cache,
+        memo=args.memo,
+        profile=args.profile,
+        save_csv=not args.no_csv,
+        store_format=None if args.store_format == 'none' else args.store_format,
+        float_rates=args.float_rates,
+        whisker_rate=args.whisker_rate,
+        chunk_rows=args.chunk_rows
     )
\ No newline at end of file
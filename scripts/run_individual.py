@@ -2,6 +2,7 @@ import os
 import sys
 import logging
 import argparse
+import matplotlib
 from src.utils.data_processing import process_data
 from datetime import datetime
 
@@ -19,7 +20,7 @@ logging.basicConfig(
 
 def run_individual(data_folder_path, results_folder=None, threshold_to_exclude_from_min_max=1,
                    threshold_to_exclude_base_on_pupil=2, plot_traces=True, save_trace_plot=True,
-                   clear_output=False, bsline_length=5, event_length=15):
+                   clear_output=False, bsline_length=5, event_length=15, use_cache=False):
     try:
         logging.info("Starting individual data processing")
 
@@ -42,7 +43,8 @@ def run_individual(data_folder_path, results_folder=None, threshold_to_exclude_f
             clear_output=clear_output,
             bsline_length=bsline_length,
             event_length=event_length,
-            results_folder=results_folder
+            results_folder=results_folder,
+            use_cache=use_cache
         )
 
         logging.info("Individual data processing completed successfully")
@@ -63,9 +65,12 @@ if __name__ == "__main__":
     parser.add_argument('--clear_output', type=bool, default=False, help='Whether to clear output')
     parser.add_argument('--bsline_length', type=int, default=5, help='Baseline length')
     parser.add_argument('--event_length', type=int, default=15, help='Event length')
+    parser.add_argument('--use_cache', action='store_true', help='Cache parsed CSV columns as binary files next to the data')
 
     # Parse arguments
     args = parser.parse_args()
+    # Scripted runs save their figures without displaying them
+    matplotlib.use('Agg')
 
     # Run the individual processing with the provided arguments
     run_individual(
@@ -77,5 +82,6 @@ if __name__ == "__main__":
         args.save_trace_plot,
         args.clear_output,
         args.bsline_length,
-        args.event_length
+        args.event_length,
+        args.use_cache
     )
\ No newline at end of file
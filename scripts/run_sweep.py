@@ -0,0 +1,41 @@
+import os
+import sys
+import argparse
+import logging
+from src.utils.sweep import run_sweep
+from src.utils.utilities import find_folders_with_csv
+
+# Add the project root to the PYTHONPATH
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep process_data parameters over a grid, reusing every stage that does not depend on the swept values.')
+    parser.add_argument('--root_folder', type=str, help='Root folder to search for CSV files')
+    parser.add_argument('--folders', nargs='+', help='List of specific folders to process')
+    parser.add_argument('--threshold_to_exclude_from_min_max', type=int, nargs='+', default=[1], help='Values of the min/max percentile threshold')
+    parser.add_argument('--threshold_to_exclude_base_on_pupil', type=float, nargs='+', default=[2], help='Values of the pupil exclusion threshold')
+    parser.add_argument('--bsline_length', type=int, nargs='+', default=[5], help='Values of the baseline length')
+    parser.add_argument('--event_length', type=int, nargs='+', default=[15], help='Values of the event length')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes running grid points in parallel')
+    parser.add_argument('--use_cache', action='store_true', help='Cache parsed CSV columns as binary files next to the data')
+    parser.add_argument('--output', type=str, default='sweep_results.csv', help='CSV file for the tidy results table')
+
+    args = parser.parse_args()
+
+    if args.root_folder:
+        folders = find_folders_with_csv(args.root_folder)
+    elif args.folders:
+        folders = args.folders
+    else:
+        parser.error("Either --root_folder or --folders must be provided")
+
+    grid = {
+        'threshold_to_exclude_from_min_max': args.threshold_to_exclude_from_min_max,
+        'threshold_to_exclude_base_on_pupil': args.threshold_to_exclude_base_on_pupil,
+        'bsline_length': args.bsline_length,
+        'event_length': args.event_length,
+    }
+    results = run_sweep(folders, grid, workers=args.workers, use_cache=args.use_cache)
+    results.to_csv(args.output, index=False)
+    print(results.to_string(index=False))
+    logging.info(f"Sweep results written to {args.output}")
@@ -0,0 +1,117 @@
+# On-disk binary cache of parsed CSV columns, stored next to the source files
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = '.cache'
+CACHE_VERSION = 1
+INDEX_COLUMN = '__index__'
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def cache_dir_for(source_path):
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(os.path.dirname(source_path), CACHE_DIR, stem)
+
+def source_signature(source_path):
+    stat = os.stat(source_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _meta_path(cache_dir):
+    return os.path.join(cache_dir, 'meta.json')
+
+def _column_path(cache_dir, idx):
+    return os.path.join(cache_dir, f'column_{idx}.npy')
+
+def _read_meta(source_path):
+    cache_dir = cache_dir_for(source_path)
+    try:
+        with open(_meta_path(cache_dir)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or meta.get('source') != source_signature(source_path):
+        return None
+    return meta
+
+def _replace_atomically(path, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def load_cached_columns(source_path, mmap_mode='r'):
+    # Returns {column: array} backed by memory maps, or None when missing or stale
+    meta = _read_meta(source_path)
+    if meta is None or meta['format'] != 'npy':
+        return None
+    cache_dir = cache_dir_for(source_path)
+    try:
+        return {name: np.load(_column_path(cache_dir, idx), mmap_mode=mmap_mode) for idx, name in enumerate(meta['columns'])}
+    except (OSError, ValueError):
+        return None
+
+def read_cache(source_path):
+    meta = _read_meta(source_path)
+    if meta is None:
+        return None
+
+    if meta['format'] == 'parquet':
+        try:
+            df = pd.read_parquet(os.path.join(cache_dir_for(source_path), 'data.parquet'), memory_map=True)
+        except (OSError, ValueError, ImportError):
+            return None
+    else:
+        columns = load_cached_columns(source_path)
+        if columns is None:
+            return None
+        # Copy out of the maps, callers normalize these frames in place
+        df = pd.DataFrame({name: np.array(values) for name, values in columns.items()})
+
+    df.index = df.pop(INDEX_COLUMN).values
+    df.columns = meta['names']
+    return df
+
+def write_cache(source_path, df, fmt='npy', signature=None):
+    # Pass the signature taken before parsing so a file rewritten mid-parse is not cached as current
+    signature = source_signature(source_path) if signature is None else signature
+    cache_dir = cache_dir_for(source_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = [INDEX_COLUMN] + [f'column_{idx}' for idx in range(df.shape[1])]
+    frame = pd.DataFrame({INDEX_COLUMN: df.index.values})
+    for idx in range(df.shape[1]):
+        frame[columns[idx + 1]] = df.iloc[:, idx].values
+
+    if fmt == 'parquet':
+        _replace_atomically(os.path.join(cache_dir, 'data.parquet'), lambda f: frame.to_parquet(f, index=False))
+    elif fmt == 'npy':
+        for idx, name in enumerate(columns):
+            _replace_atomically(_column_path(cache_dir, idx), lambda f: np.save(f, np.ascontiguousarray(frame[name].values)))
+    else:
+        raise ValueError(f"Unknown cache format: {fmt}")
+
+    meta = {'version': CACHE_VERSION, 'source': signature, 'format': fmt, 'columns': columns, 'names': [str(name) for name in df.columns]}
+    _replace_atomically(_meta_path(cache_dir), lambda f: f.write(json.dumps(meta).encode()))
+
+def cached_read(source_path, parse, fmt='npy'):
+    df = read_cache(source_path)
+    if df is not None:
+        return df
+
+    signature = source_signature(source_path)
+    df = parse(source_path)
+    if fmt == 'parquet' and not parquet_available():
+        fmt = 'npy'
+    try:
+        write_cache(source_path, df, fmt, signature)
+    except OSError as e:
+        logging.warning(f"Could not write cache for {source_path}: {e}")
+    return df
@@ -1,31 +1,52 @@
 import pandas as pd
 import numpy as np
 import os
+from src.data.cache import cached_read
+from src.data.mmap_loader import WHISKER_DURATION, whisker_time_axis
 
 def load_data(file_path):
     return pd.read_csv(file_path)
 
-def load_arteriole_data(data_folder_path):
-    arteriole_diameter_df = pd.read_csv(os.path.join(data_folder_path, 'arteriole_diameter.csv'))
+def _load(file_path, parse, use_cache):
+    return cached_read(file_path, parse) if use_cache else parse(file_path)
+
+def _read_arteriole_csv(file_path):
+    arteriole_diameter_df = pd.read_csv(file_path)
     arteriole_diameter_df.columns = ['time', 'arteriole_diameter']
     arteriole_diameter_df.dropna(inplace=True)
     return arteriole_diameter_df
 
-def load_calcium_data(data_folder_path):
-    calcium_df = pd.read_csv(os.path.join(data_folder_path, 'calcium.csv'))
+def _read_calcium_csv(file_path):
+    calcium_df = pd.read_csv(file_path)
     calcium_df.columns = ['time', 'calcium']
     calcium_df.dropna(inplace=True)
     return calcium_df
 
-def load_pupil_data(data_folder_path):
-    pupil_size_df = pd.read_csv(os.path.join(data_folder_path, 'pupil_size.csv'))
+def _read_pupil_csv(file_path):
+    pupil_size_df = pd.read_csv(file_path)
     pupil_size_df.columns = ['time', 'pupil_size']
     pupil_size_df.dropna(inplace=True)
     return pupil_size_df
 
-def load_whisker_data(data_folder_path):
-    resampled_whisker_angle_df = pd.read_csv(os.path.join(data_folder_path, 'resampled_whiskerAngle.csv'), header=None)
+def _read_whisker_csv(file_path):
+    resampled_whisker_angle_df = pd.read_csv(file_path, header=None)
     resampled_whisker_angle_df.dropna(inplace=True)
-    resampled_whisker_angle_df['time'] = np.linspace(0, 900, resampled_whisker_angle_df[0].shape[0])
+    resampled_whisker_angle_df['time'] = np.linspace(0, WHISKER_DURATION, resampled_whisker_angle_df[0].shape[0])
     resampled_whisker_angle_df.columns = ['whisker_angle', 'time']
-    return resampled_whisker_angle_df
\ No newline at end of file
+    return resampled_whisker_angle_df
+
+def load_arteriole_data(data_folder_path, use_cache=False):
+    return _load(os.path.join(data_folder_path, 'arteriole_diameter.csv'), _read_arteriole_csv, use_cache)
+
+def load_calcium_data(data_folder_path, use_cache=False):
+    return _load(os.path.join(data_folder_path, 'calcium.csv'), _read_calcium_csv, use_cache)
+
+def load_pupil_data(data_folder_path, use_cache=False):
+    return _load(os.path.join(data_folder_path, 'pupil_size.csv'), _read_pupil_csv, use_cache)
+
+def load_whisker_data(data_folder_path, use_cache=False, duration=WHISKER_DURATION, sampling_rate=None):
+    # The time column spans duration seconds, or follows sampling_rate when the trace's rate is known
+    whisker_df = _load(os.path.join(data_folder_path, 'resampled_whiskerAngle.csv'), _read_whisker_csv, use_cache)
+    if duration != WHISKER_DURATION or sampling_rate is not None:
+        whisker_df = whisker_df.assign(time=whisker_time_axis(whisker_df.shape[0], duration, sampling_rate)[:])
+    return whisker_df
@@ -0,0 +1,159 @@
+# Zero-copy loading: the angle column is converted once to a raw float64 file and memory-mapped
+# read-only, the whisker time axis is generated on demand from the sampling rate. The (time, value)
+# CSVs of the other modalities convert the same way to an (n, 2) file for out-of-core processing
+import os
+import json
+import numpy as np
+import pandas as pd
+from src.data.cache import cache_dir_for, source_signature
+
+WHISKER_FILE = 'resampled_whiskerAngle.csv'
+WHISKER_DURATION = 900
+CONVERT_CHUNKSIZE = 1_000_000
+# Samples of a generated time axis materialized at once by block-wise computations
+AXIS_BLOCK = 1 << 20
+
+class LinearTimeAxis:
+    # Matches np.linspace(start, stop, n_samples) element for element without storing it; head(n)
+    # is its first n samples, still generated on demand
+    def __init__(self, n_samples, start=0.0, stop=WHISKER_DURATION):
+        self.n_samples = int(n_samples)
+        self.start = float(start)
+        self.stop = float(stop)
+        self.step = (self.stop - self.start) / (self.n_samples - 1) if self.n_samples > 1 else np.nan
+        self.length = self.n_samples
+
+    @classmethod
+    def from_sampling_rate(cls, n_samples, sampling_rate, start=0.0):
+        return cls(n_samples, start, start + (n_samples - 1) / sampling_rate)
+
+    @property
+    def sampling_rate(self):
+        return 1 / self.step
+
+    @property
+    def shape(self):
+        return (self.length,)
+
+    def __len__(self):
+        return self.length
+
+    def head(self, length):
+        prefix = LinearTimeAxis(self.n_samples, self.start, self.stop)
+        prefix.length = min(max(int(length), 0), self.length)
+        return prefix
+
+    def blocks(self, block_size=AXIS_BLOCK, overlap=0):
+        # (first index, samples) of consecutive slices, each reaching overlap samples into the previous one
+        for start in range(0, self.length, block_size):
+            first = max(start - overlap, 0)
+            yield first, self[first:min(start + block_size, self.length)]
+
+    def _at(self, indices):
+        values = np.asarray(indices, dtype=float) * self.step + self.start
+        return np.where(np.asarray(indices) == self.n_samples - 1, self.stop, values) if self.n_samples > 1 else np.full(values.shape, self.start)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._at(np.arange(*key.indices(self.length)))
+        indices = np.asarray(key)
+        if indices.dtype == bool:
+            return self._at(np.flatnonzero(indices))
+        indices = np.where(indices < 0, indices + self.length, indices)
+        if np.any((indices < 0) | (indices >= self.length)):
+            raise IndexError(f"index out of range for time axis of length {self.length}")
+        values = self._at(indices)
+        return values.item() if values.ndim == 0 else values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self._at(np.arange(self.length))
+        return values if dtype is None else values.astype(dtype)
+
+    def searchsorted(self, times, side='left'):
+        # Analytic guess refined against the exact sample values
+        times = np.asarray(times, dtype=float)
+        if self.length <= 1:
+            return np.searchsorted(self[:], times, side=side)
+        guess = np.clip(np.floor((times - self.start) / self.step).astype(np.int64), 0, self.length - 1)
+        lo = np.clip(guess - 1, 0, self.length)
+        hi = np.clip(guess + 2, 0, self.length)
+        result = lo.copy()
+        for offset in range(3):
+            candidate = lo + offset
+            valid = candidate < hi
+            values = self._at(np.minimum(candidate, self.length - 1))
+            passed = valid & ((values < times) if side == 'left' else (values <= times))
+            result = np.where(passed, candidate + 1, result)
+        return result
+
+def _binary_paths(source_path, name='angle'):
+    cache_dir = cache_dir_for(source_path)
+    return cache_dir, os.path.join(cache_dir, f'{name}.f64'), os.path.join(cache_dir, f'{name}.json')
+
+def _convert_csv(source_path, name, header, chunksize):
+    # Streams the CSV into a little-endian float64 file so parsing never holds the whole text
+    signature = source_signature(source_path)
+    cache_dir, binary_path, meta_path = _binary_paths(source_path, name)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    n_samples = 0
+    tmp_path = f'{binary_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in pd.read_csv(source_path, header=header, chunksize=chunksize):
+            values = chunk.dropna().to_numpy(dtype='<f8')
+            values.tofile(f)
+            n_samples += values.shape[0]
+    os.replace(tmp_path, binary_path)
+
+    with open(f'{meta_path}.{os.getpid()}.tmp', 'w') as f:
+        json.dump({'source': signature, 'n_samples': n_samples}, f)
+    os.replace(f'{meta_path}.{os.getpid()}.tmp', meta_path)
+    return n_samples
+
+def convert_whisker_csv(source_path, chunksize=CONVERT_CHUNKSIZE):
+    return _convert_csv(source_path, 'angle', None, chunksize)
+
+def convert_timeseries_csv(source_path, chunksize=CONVERT_CHUNKSIZE):
+    # Rows of a headed (time, value) CSV with NaN rows dropped, as the CSV loaders drop them
+    return _convert_csv(source_path, 'columns', 'infer', chunksize)
+
+def _converted_samples(source_path, name='angle'):
+    _, binary_path, meta_path = _binary_paths(source_path, name)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('source') != source_signature(source_path) or not os.path.exists(binary_path):
+        return None
+    return meta['n_samples']
+
+def load_whisker_mmap(data_folder_path, duration=WHISKER_DURATION, sampling_rate=None):
+    # Returns (whisker_angle, whisker_time): a read-only memmap and a LinearTimeAxis
+    source_path = os.path.join(data_folder_path, WHISKER_FILE)
+    n_samples = _converted_samples(source_path)
+    if n_samples is None:
+        n_samples = convert_whisker_csv(source_path)
+
+    _, binary_path, _ = _binary_paths(source_path)
+    whisker_angle = np.memmap(binary_path, dtype='<f8', mode='r', shape=(n_samples,)) if n_samples else np.empty(0)
+    return whisker_angle, whisker_time_axis(n_samples, duration, sampling_rate)
+
+def whisker_time_axis(n_samples, duration=WHISKER_DURATION, sampling_rate=None):
+    # The resampled whisker trace carries no clock: it spans duration seconds unless its rate is known
+    if sampling_rate is None:
+        return LinearTimeAxis(n_samples, 0, duration)
+    return LinearTimeAxis.from_sampling_rate(n_samples, sampling_rate)
+
+def load_timeseries_mmap(data_folder_path, file_name):
+    # Returns (time, values): read-only memmaps of the two columns of a (time, value) CSV
+    source_path = os.path.join(data_folder_path, file_name)
+    n_samples = _converted_samples(source_path, 'columns')
+    if n_samples is None:
+        n_samples = convert_timeseries_csv(source_path)
+
+    _, binary_path, _ = _binary_paths(source_path, 'columns')
+    if not n_samples:
+        return np.empty(0), np.empty(0)
+    columns = np.memmap(binary_path, dtype='<f8', mode='r', shape=(n_samples, 2))
+    return columns[:, 0], columns[:, 1]
@@ -0,0 +1,76 @@
+# Synthetic acquisition cycles in the CSV layouts the loaders expect, for benchmarks and
+# regression checks at trace lengths the real test cycles do not cover
+import os
+import json
+import numpy as np
+import pandas as pd
+
+PUPIL_SAMPLING_RATE = 50
+WHISKER_SAMPLING_RATE = 50
+IMAGING_SAMPLING_RATE = 1 / 0.51150895
+# The whisker loader spreads the angle samples over 0-900 s whatever their count, unless it is
+# given their sampling rate
+WHISKER_LOADER_DURATION = 900
+
+def _alpha_response(time, onsets, rise, decay):
+    # Sum of smooth rise-and-decay responses starting at every onset
+    response = np.zeros_like(time)
+    for onset in onsets:
+        start, stop = np.searchsorted(time, [onset, onset + rise + 6 * decay])
+        lag = time[start:stop] - onset
+        response[start:stop] += (1 - np.exp(-lag / rise)) * np.exp(-lag / decay)
+    return response
+
+def synthetic_signals(duration=900, pupil_sampling_rate=PUPIL_SAMPLING_RATE, whisker_sampling_rate=WHISKER_SAMPLING_RATE,
+                      imaging_sampling_rate=IMAGING_SAMPLING_RATE, blink_rate=2, event_rate=0.4, seed=0):
+    # blink_rate and event_rate are per minute, onsets are evenly spread with some jitter
+    rng = np.random.default_rng(seed)
+    n_events = max(int(duration / 60 * event_rate), 1)
+    spacing = (duration - 60) / n_events
+    onsets = 30 + spacing * (np.arange(n_events) + 0.5) + rng.uniform(-0.2, 0.2, n_events) * spacing
+
+    pupil_time = np.round(np.arange(1, int(duration * pupil_sampling_rate) + 1) / pupil_sampling_rate, 6)
+    # Slow bounded drift: white noise low-passed over 10 s, unit standard deviation
+    drift = np.convolve(rng.normal(0, 1, pupil_time.shape[0]), np.ones(10 * pupil_sampling_rate), mode='same')
+    drift /= drift.std()
+    pupil_size = 40 + drift + 12 * _alpha_response(pupil_time, onsets, 2.0, 12.0) + rng.normal(0, 0.15, pupil_time.shape[0])
+
+    n_blinks = rng.poisson(duration / 60 * blink_rate)
+    for blink in rng.uniform(0, duration, n_blinks):
+        start, stop = np.searchsorted(pupil_time, [blink, blink + rng.uniform(0.15, 0.4)])
+        pupil_size[start:stop] = rng.uniform(5, 15)
+
+    n_whisker = int(duration * whisker_sampling_rate) + 1
+    whisker_time = np.linspace(0, duration, n_whisker)
+    whisking = np.zeros(n_whisker)
+    for onset in onsets:
+        start, stop = np.searchsorted(whisker_time, [onset, onset + rng.uniform(8, 14)])
+        whisking[start:stop] = 15 * np.sin(2 * np.pi * 9 * whisker_time[start:stop])
+    whisker_angle = rng.normal(0, 0.05, n_whisker).cumsum() * 0.1 + whisking + rng.normal(0, 0.2, n_whisker)
+
+    imaging_time = np.arange(1, int(duration * imaging_sampling_rate) + 1) / imaging_sampling_rate
+    imaging_response = _alpha_response(imaging_time, onsets, 3.0, 8.0)
+    calcium = 550 + 120 * imaging_response + rng.normal(0, 15, imaging_time.shape[0])
+    arteriole = 1800 + 400 * _alpha_response(imaging_time, onsets + 1.5, 3.0, 10.0) + rng.normal(0, 40, imaging_time.shape[0])
+
+    return {
+        'event_times': onsets,
+        'pupil': pd.DataFrame({'time': pupil_time, 'pupil_size': pupil_size}),
+        'whisker_angle': whisker_angle,
+        'calcium': pd.DataFrame({'time': imaging_time, 'calcium': calcium}),
+        'arteriole': pd.DataFrame({'time': imaging_time, 'arteriole_diameter': arteriole}),
+    }
+
+def write_synthetic_cycle(data_folder_path, cycle_number=1, **kwargs):
+    # Writes the four CSVs of a cycle plus synthetic.json with the generator settings and injected event times
+    signals = synthetic_signals(**kwargs)
+    os.makedirs(data_folder_path, exist_ok=True)
+
+    signals['pupil'].to_csv(os.path.join(data_folder_path, 'pupil_size.csv'), header=['time', f'cycle {cycle_number}'], index=False)
+    signals['calcium'].to_csv(os.path.join(data_folder_path, 'calcium.csv'), header=['time', ''], index=False)
+    signals['arteriole'].to_csv(os.path.join(data_folder_path, 'arteriole_diameter.csv'), header=['time', 'Cross_Sectional_Area_ROI_1'], index=False)
+    np.savetxt(os.path.join(data_folder_path, 'resampled_whiskerAngle.csv'), signals['whisker_angle'], fmt='%.18e')
+
+    with open(os.path.join(data_folder_path, 'synthetic.json'), 'w') as f:
+        json.dump({'cycle_number': cycle_number, **kwargs, 'event_times': signals['event_times'].tolist()}, f, indent=2)
+    return signals['event_times']
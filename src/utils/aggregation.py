@@ -0,0 +1,118 @@
+# Population averages of the event windows across many processed cycles. Cycles are read one at
+# a time and folded into per-sample running mean/variance, so memory does not grow with the
+# number of cycles or events
+import os
+import logging
+import numpy as np
+import pandas as pd
+from src.utils.results_store import MODALITIES, find_results_file, load_results, windows_from_frame
+
+GROUP_BY = ('all', 'date', 'cycle')
+
+class RunningStats:
+    # Per-sample Welford mean and variance over the rows of window matrices, NaN samples are skipped
+    def __init__(self, time_event):
+        self.time_event = np.asarray(time_event, dtype=float)
+        self.count = np.zeros(self.time_event.shape[0], dtype=np.int64)
+        self.mean = np.zeros(self.time_event.shape[0])
+        self.m2 = np.zeros(self.time_event.shape[0])
+        self.n_cycles = 0
+
+    def update(self, windows):
+        # Merges a whole (events x samples) batch at once with the pairwise update of Chan et al.
+        windows = np.asarray(windows, dtype=float).reshape(-1, self.time_event.shape[0])
+        valid = ~np.isnan(windows)
+        batch_count = valid.sum(axis=0)
+        if not batch_count.any():
+            return self
+        filled = np.where(valid, windows, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch_mean = np.where(batch_count > 0, filled.sum(axis=0) / batch_count, 0.0)
+        batch_m2 = (np.where(valid, windows - batch_mean, 0.0) ** 2).sum(axis=0)
+
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        safe_total = np.maximum(total, 1)
+        self.mean = self.mean + delta * batch_count / safe_total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * batch_count / safe_total
+        self.count = total
+        self.n_cycles += 1
+        return self
+
+    @property
+    def variance(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def sem(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(self.variance / self.count)
+
+    def to_frame(self):
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        return pd.DataFrame({
+            'Time (s)': self.time_event, 'n_events': self.count, 'mean': mean,
+            'std': np.sqrt(self.variance), 'sem': self.sem, 'ci95': 1.96 * self.sem,
+        })
+
+def find_results_folders(results_root):
+    # Folders below results_root holding a results store or window CSVs, in sorted order
+    folders = []
+    for folder, _, files in os.walk(results_root):
+        if find_results_file(folder) is not None or any(file.endswith('_windows.csv') for file in files):
+            folders.append(folder)
+    return sorted(folders)
+
+def iter_cycle_windows(results_folder, modalities=MODALITIES):
+    # (modality, time axis, windows) of one cycle, from the results store when present
+    results_file = find_results_file(results_folder)
+    store = load_results(results_file) if results_file is not None else None
+    for modality in modalities:
+        if store is not None and f'{modality}_windows' in store:
+            yield modality, store[f'{modality}_time'], store[f'{modality}_windows']
+            continue
+        windows_file = os.path.join(results_folder, f'{modality}_windows.csv')
+        if os.path.exists(windows_file):
+            yield (modality, *windows_from_frame(pd.read_csv(windows_file, float_precision='round_trip')))
+
+def group_key(results_folder, results_root, group_by='all'):
+    # 'date' groups cycles by their date folder (e.g. 2023.06.01), 'cycle' keeps every folder apart
+    if group_by == 'all':
+        return 'all'
+    relative = os.path.relpath(results_folder, results_root)
+    if group_by == 'cycle':
+        return relative
+    if group_by == 'date':
+        parent = os.path.dirname(relative)
+        return os.path.basename(parent) if parent else relative
+    raise ValueError(f"Unknown grouping: {group_by}")
+
+def aggregate_results(results_root, group_by='all', modalities=MODALITIES):
+    # {(group, modality): RunningStats} over every cycle below results_root
+    stats = {}
+    for results_folder in find_results_folders(results_root):
+        group = group_key(results_folder, results_root, group_by)
+        for modality, time_event, windows in iter_cycle_windows(results_folder, modalities):
+            key = (group, modality)
+            if key not in stats:
+                stats[key] = RunningStats(time_event)
+            elif time_event.shape != stats[key].time_event.shape:
+                logging.warning(f"Skipping {modality} windows of {results_folder}: {time_event.shape[0]} samples, "
+                                f"expected {stats[key].time_event.shape[0]}")
+                continue
+            stats[key].update(windows)
+    return stats
+
+def aggregate_frame(stats):
+    # Tidy (group, modality, time) table of the running statistics
+    frames = []
+    for (group, modality), running in stats.items():
+        frame = running.to_frame()
+        frame.insert(0, 'modality', modality)
+        frame.insert(0, 'group', group)
+        frame.insert(3, 'n_cycles', running.n_cycles)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['group', 'modality', 'Time (s)', 'n_cycles', 'n_events', 'mean', 'std', 'sem', 'ci95'])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,338 @@
+# Out-of-core process_data for recordings too long to hold in memory, e.g. sessions of several
+# hours at 50 Hz. Every CSV is converted once to a memory-mapped float64 file and then read
+# chunk_rows samples at a time, so peak memory follows chunk_rows rather than the recording:
+#   1. the constants detect_events takes from the whole recording (pupil median and std, blink
+#      threshold, percentile bounds) are computed block by block. They are exact: the order
+#      statistics are narrowed down by histogram passes over the blocks instead of a sort
+#   2. the blocks are fed in time order to StreamingEventDetector calibrated with these constants.
+#      Its buffers carry the last bsline_length + event_length seconds of every stage into the next
+#      block, so blink removal, smoothing and detect_sudden_change_events see the same samples as
+#      on the whole trace and every event is reported once, at its absolute sample index
+#   3. only the event windows of each modality are read back from the memory maps
+import logging
+import numpy as np
+from src.data.mmap_loader import load_timeseries_mmap, load_whisker_mmap
+from src.utils.processing import (
+    gather_windows, percent_change_from_baseline, exclude_outlier_events, event_time_axis, save_modality_windows,
+    copy_windows_csv,
+)
+from src.utils.profiling import profile_stage
+from src.utils.streaming import StreamingEventDetector
+from src.utils.timebase import Timebase
+from src.utils.timing import DROP_FACTOR, integer_rate, window_sizes, check_timing
+from src.utils.utilities import merge_intervals, blink_interval_mask, moving_average
+
+CHUNK_ROWS = 500_000
+# Bins of every histogram pass of order_statistics, and the candidate count sorted in memory
+SELECT_BINS = 4096
+MAX_GATHER = 1 << 16
+
+def block_slices(n_samples, chunk_rows=CHUNK_ROWS, overlap=0):
+    # (start, stop) of consecutive blocks, each reaching overlap samples back into the previous one
+    for start in range(0, n_samples, chunk_rows):
+        yield max(start - overlap, 0), min(start + chunk_rows, n_samples)
+
+def _summary(blocks):
+    n_values, n_nan, low, high = 0, 0, np.inf, -np.inf
+    for block in blocks():
+        block = np.asarray(block, dtype=float)
+        values = block[~np.isnan(block)]
+        n_nan += block.shape[0] - values.shape[0]
+        if values.shape[0]:
+            n_values += values.shape[0]
+            low, high = min(low, values.min()), max(high, values.max())
+    return n_values, n_nan, low, high
+
+def order_statistics(blocks, ranks, summary=None):
+    # Value of each rank (0-based, ascending, NaN ignored) of the concatenated blocks, where blocks()
+    # returns a fresh iterator over 1-D arrays. Each rank keeps a closed value range holding it and
+    # the count of values below the range; histogram passes shrink the ranges until they hold few
+    # enough values, or distinct values, to be gathered and counted exactly
+    n_values, _, low, high = _summary(blocks) if summary is None else summary
+    ranks = np.asarray(ranks, dtype=np.int64)
+    if n_values == 0:
+        return np.full(ranks.shape, np.nan)
+    lows, highs = np.full(ranks.shape, low), np.full(ranks.shape, high)
+    below = np.zeros(ranks.shape, dtype=np.int64)
+    counts = np.full(ranks.shape, n_values, dtype=np.int64)
+    stalled = np.zeros(ranks.shape, dtype=bool)
+
+    while True:
+        targets = np.flatnonzero((counts > MAX_GATHER) & (lows < highs) & ~stalled)
+        if targets.shape[0] == 0:
+            break
+        edges = [np.linspace(lows[i], highs[i], SELECT_BINS + 1) for i in targets]
+        histograms = np.zeros((targets.shape[0], SELECT_BINS), dtype=np.int64)
+        for block in blocks():
+            block = np.asarray(block, dtype=float)
+            for j, i in enumerate(targets):
+                inside = block[(block >= lows[i]) & (block <= highs[i])]
+                bins = np.minimum(np.searchsorted(edges[j], inside, side='right') - 1, SELECT_BINS - 1)
+                histograms[j] += np.bincount(bins, minlength=SELECT_BINS)
+        for j, i in enumerate(targets):
+            cumulative = np.cumsum(histograms[j])
+            b = int(np.searchsorted(cumulative, ranks[i] - below[i], side='right'))
+            low = edges[j][b]
+            high = highs[i] if b == SELECT_BINS - 1 else np.nextafter(edges[j][b + 1], -np.inf)
+            # A range a few floats wide cannot be split further, its distinct values are counted
+            stalled[i] = low == lows[i] and high == highs[i]
+            below[i] += cumulative[b] - histograms[j][b]
+            counts[i] = histograms[j][b]
+            lows[i], highs[i] = low, high
+
+    distinct = [[] for _ in ranks]
+    for block in blocks():
+        block = np.asarray(block, dtype=float)
+        for i in range(ranks.shape[0]):
+            distinct[i].append(np.unique(block[(block >= lows[i]) & (block <= highs[i])], return_counts=True))
+    values = np.empty(ranks.shape)
+    for i, parts in enumerate(distinct):
+        uniques, inverse = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+        multiplicity = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]))
+        values[i] = uniques[np.searchsorted(np.cumsum(multiplicity), ranks[i] - below[i], side='right')]
+    return values
+
+def block_percentiles(blocks, percentiles):
+    # np.percentile (linear method) of the concatenated blocks without concatenating them
+    summary = _summary(blocks)
+    n_values, n_nan = summary[:2]
+    quantiles = np.true_divide(np.asarray(percentiles, dtype=float), 100)
+    if n_values == 0 or n_nan:
+        return np.full(quantiles.shape, np.nan)
+
+    virtual = (n_values - 1) * quantiles
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous = np.minimum(previous.astype(np.int64), n_values - 1)
+    values = order_statistics(blocks, np.concatenate([previous, np.minimum(previous + 1, n_values - 1)]), summary)
+    below, above = values[:quantiles.shape[0]], values[quantiles.shape[0]:]
+    # numpy's lerp, exact at both ends of the interval
+    difference = above - below
+    return np.where(gamma >= 0.5, above - difference * (1 - gamma), below + difference * gamma)
+
+def block_median(blocks):
+    summary = _summary(blocks)
+    n_values = summary[0]
+    if n_values == 0:
+        return np.nan
+    lower, upper = order_statistics(blocks, [(n_values - 1) // 2, n_values // 2], summary)
+    return lower if n_values % 2 else np.mean([lower, upper])
+
+def block_std(blocks, ddof=1):
+    # Two passes, mean then squared deviations, as pandas computes Series.std
+    n_values, total = 0, 0.0
+    for block in blocks():
+        n_values += len(block)
+        total += np.sum(block)
+    mean = total / n_values
+    squares = sum(np.sum((mean - np.asarray(block, dtype=float)) ** 2) for block in blocks())
+    return np.sqrt(squares / (n_values - ddof))
+
+def block_stream_timing(time, chunk_rows=CHUNK_ROWS):
+    # stream_timing of a clock read one block of intervals at a time
+    n_samples = len(time)
+    intervals = lambda: (np.diff(np.asarray(time[start:stop], dtype=float)) for start, stop in block_slices(n_samples, chunk_rows, overlap=1))
+    median_interval = float(block_median(intervals)) if n_samples > 1 else np.nan
+    if not median_interval > 0:
+        return {'n_samples': n_samples, 'start': float(time[0]) if n_samples else np.nan, 'duration': np.nan,
+                'median_interval': np.nan, 'rate': np.nan, 'mean_rate': np.nan, 'jitter': np.nan, 'gaps': 0, 'dropped_frames': 0}
+
+    total, n_gaps, dropped, n_regular, regular_total = 0.0, 0, 0.0, 0, 0.0
+    for block in intervals():
+        gaps = block > DROP_FACTOR * median_interval
+        total += np.sum(block)
+        n_gaps += int(gaps.sum())
+        dropped += np.round(block[gaps] / median_interval).sum() - gaps.sum()
+        n_regular += int((~gaps).sum())
+        regular_total += np.sum(block[~gaps])
+    regular_mean = regular_total / n_regular if n_regular else 0.0
+    squares = sum(np.sum((block[block <= DROP_FACTOR * median_interval] - regular_mean) ** 2) for block in intervals())
+    return {
+        'n_samples': n_samples,
+        'start': float(time[0]),
+        'duration': float(time[n_samples - 1] - time[0]),
+        'median_interval': median_interval,
+        'rate': 1 / median_interval,
+        'mean_rate': 1 / (total / (n_samples - 1)),
+        'jitter': float(np.sqrt(squares / n_regular) / median_interval) if n_regular else 0.0,
+        'gaps': n_gaps,
+        'dropped_frames': int(dropped),
+    }
+
+def calibrate_in_blocks(pupil_time, pupil_size, whisker_time, whisker_angle, pupil_sampling_rate, threshold_to_exclude_from_min_max=1,
+                        blink_quantile=0.001, blink_window=1, chunk_rows=CHUNK_ROWS):
+    # calibrate_from_recording over memory-mapped streams, plus 'pupil_size_bounds', the bounds
+    # normalize_series gives the normalized pupil trace the pupil windows are cut from
+    n_pupil, n_whisker = len(pupil_size), len(whisker_angle)
+    raw = lambda: (np.asarray(pupil_size[start:stop], dtype=float) for start, stop in block_slices(n_pupil, chunk_rows))
+    center, scale = block_median(raw), block_std(raw)
+    normalized = lambda: ((block - center) / scale for block in raw())
+    changes = lambda: (np.diff((np.asarray(pupil_size[start:stop], dtype=float) - center) / scale)
+                       for start, stop in block_slices(n_pupil, chunk_rows, overlap=1))
+    blink_threshold = block_percentiles(changes, [blink_quantile * 100.0])[0]
+
+    # Blinks are rare, their intervals are merged over the whole recording up front
+    drop_times = []
+    for (start, stop), change in zip(block_slices(n_pupil, chunk_rows, overlap=1), changes()):
+        drop_times.append(np.asarray(pupil_time[start + 1:stop], dtype=float)[change < blink_threshold])
+    drop_times = np.concatenate(drop_times) if drop_times else np.empty(0)
+    blink_intervals = merge_intervals(drop_times - blink_window, drop_times + blink_window)
+
+    def smoothed():
+        # The last window - 1 clean samples of a block open the next, as in one pass over the trace
+        window, carried = pupil_sampling_rate, np.empty(0)
+        for (start, stop), block in zip(block_slices(n_pupil, chunk_rows), normalized()):
+            removed = blink_interval_mask(np.asarray(pupil_time[start:stop], dtype=float), blink_intervals)
+            carried = np.concatenate([carried, block[~removed]])
+            if carried.shape[0] >= window:
+                yield moving_average(carried, window)
+                carried = carried[carried.shape[0] - window + 1:]
+
+    def whisker_power():
+        for start, stop in block_slices(n_whisker, chunk_rows, overlap=1):
+            angle, time = np.asarray(whisker_angle[start:stop], dtype=float), np.asarray(whisker_time[start:stop], dtype=float)
+            yield np.power(np.diff(angle) / np.diff(time), 2)
+
+    bounds = [threshold_to_exclude_from_min_max, 100 - threshold_to_exclude_from_min_max]
+    return {
+        'pupil_center': center,
+        'pupil_scale': scale,
+        'blink_threshold': blink_threshold,
+        'pupil_bounds': tuple(block_percentiles(smoothed, bounds)),
+        'whisker_bounds': tuple(block_percentiles(whisker_power, [1, 99])),
+        'pupil_size_bounds': tuple(block_percentiles(normalized, bounds)),
+    }
+
+def _push_whisker(detector, whisker_time, whisker_angle, start, stop, chunk_rows):
+    for block_start, block_stop in block_slices(stop - start, chunk_rows):
+        detector.push_whisker(whisker_time[start + block_start:start + block_stop], whisker_angle[start + block_start:start + block_stop])
+
+def detect_events_in_blocks(pupil_time, pupil_size, whisker_time, whisker_angle, pupil_sampling_rate, whisker_sampling_rate, calibration,
+                            bsline_length=5, event_length=15, threshold_to_exclude_from_min_max=1, chunk_rows=CHUNK_ROWS):
+    # Events of detect_events as {'index', 'time', 'integral_ratio'}, index into the smoothed trace.
+    # whisker_time is the LinearTimeAxis of load_whisker_mmap
+    detector = StreamingEventDetector(pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length,
+                                      threshold_to_exclude_from_min_max, calibration)
+    n_whisker, whisker_start = len(whisker_angle), 0
+    for start, stop in block_slices(len(pupil_size), chunk_rows):
+        block_time = np.asarray(pupil_time[start:stop], dtype=float)
+        # Whisker samples up to the end of the pupil block go first, as they would arrive live
+        whisker_stop = max(int(whisker_time.searchsorted(block_time[-1], side='right')), whisker_start)
+        _push_whisker(detector, whisker_time, whisker_angle, whisker_start, whisker_stop, chunk_rows)
+        whisker_start = whisker_stop
+        detector.push_pupil(block_time, pupil_size[start:stop])
+    _push_whisker(detector, whisker_time, whisker_angle, whisker_start, n_whisker, chunk_rows)
+    detector.finish()
+    return detector.events
+
+def event_onsets(time, event_times, chunk_rows=CHUNK_ROWS):
+    # Timebase.left_index of a clock read one block at a time: samples strictly before each event
+    event_times = np.asarray(event_times, dtype=float)
+    onsets = np.zeros(event_times.shape[0], dtype=np.int64)
+    for start, stop in block_slices(len(time), chunk_rows):
+        onsets += Timebase(time[start:stop]).left_index(event_times)
+    return onsets
+
+def _event_time_axis(time, sampling_rate, bsline_length, event_length):
+    # event_time_axis reading only the leading samples of the clock
+    return event_time_axis(np.asarray(time[:sum(window_sizes(sampling_rate, bsline_length, event_length))], dtype=float),
+                           sampling_rate, bsline_length, event_length)
+
+def open_recording(data_folder_path, whisker_rate=None):
+    # Memory maps of every stream, converted from the CSVs on first use
+    pupil_time, pupil_size = load_timeseries_mmap(data_folder_path, 'pupil_size.csv')
+    calcium_time, calcium = load_timeseries_mmap(data_folder_path, 'calcium.csv')
+    arteriole_time, arteriole_diameter = load_timeseries_mmap(data_folder_path, 'arteriole_diameter.csv')
+    whisker_angle, whisker_time = load_whisker_mmap(data_folder_path, sampling_rate=whisker_rate)
+    return {
+        'pupil': (pupil_time, pupil_size),
+        'calcium': (calcium_time, calcium),
+        'arteriole': (arteriole_time, arteriole_diameter),
+        'whisker': (whisker_time, whisker_angle),
+    }
+
+def process_in_chunks(data_folder_path, results_path, threshold_to_exclude_from_min_max=1, threshold_to_exclude_base_on_pupil=2, plot_traces=False,
+                      bsline_length=5, event_length=15, save_csv=True, float_rates=False, whisker_rate=None, chunk_rows=CHUNK_ROWS):
+    # The modality outputs of process_data; returns what it stores alongside them
+    with profile_stage('load'):
+        logging.info("Converting the CSVs to memory maps")
+        streams = open_recording(data_folder_path, whisker_rate)
+        pupil_time, pupil_size = streams['pupil']
+        whisker_time, whisker_angle = streams['whisker']
+
+        logging.info("Calculating sampling rates")
+        timing = {name: block_stream_timing(streams[name][0], chunk_rows) for name in ('arteriole', 'calcium', 'pupil', 'whisker')}
+        check_timing(timing)
+        rates = {name: integer_rate(stream_timing) for name, stream_timing in timing.items()}
+
+    logging.info("Calibrating the normalization on the whole recording")
+    with profile_stage('calibrate'):
+        calibration = calibrate_in_blocks(pupil_time, pupil_size, whisker_time, whisker_angle, rates['pupil'],
+                                          threshold_to_exclude_from_min_max, chunk_rows=chunk_rows)
+
+    logging.info("Detecting events")
+    with profile_stage('detect'):
+        events = detect_events_in_blocks(pupil_time, pupil_size, whisker_time, whisker_angle, rates['pupil'], rates['whisker'], calibration,
+                                         bsline_length, event_length, threshold_to_exclude_from_min_max, chunk_rows)
+    detected_events = np.array([event['index'] for event in events], dtype=int)
+    event_times = np.array([event['time'] for event in events], dtype=float)
+
+    if float_rates:
+        # Windows sized from the measured median rates, as in process_data
+        rates = {name: stream_timing['rate'] for name, stream_timing in timing.items()}
+
+    def windows(name, values=None, normalize=True):
+        time, stream = streams[name]
+        baseline_size, event_size = window_sizes(rates[name], bsline_length, event_length)
+        starts = event_onsets(time, event_times, chunk_rows) - baseline_size
+        extracted = gather_windows(stream if values is None else values, starts, baseline_size + event_size)
+        return percent_change_from_baseline(extracted, baseline_size) if normalize else extracted
+
+    frames = {}
+    logging.info("Processing and saving pupil data")
+    with profile_stage('pupil'):
+        with profile_stage('extract'):
+            # normalize_mean_std then normalize_series, on the window samples only
+            min_val, max_val = calibration['pupil_size_bounds']
+            pupil_windows = ((windows('pupil', normalize=False) - calibration['pupil_center']) / calibration['pupil_scale'] - min_val) / (max_val - min_val)
+        pupil_windows, clean_events = exclude_outlier_events(pupil_windows, detected_events, threshold_to_exclude_base_on_pupil)
+        time_event = _event_time_axis(pupil_time, rates['pupil'], bsline_length, event_length)
+        frames['pupil'] = save_modality_windows(pupil_windows, time_event, 'pupil', 'Pupil Size', results_path, save_csv, plot_traces)
+    event_times = event_times[np.isin(detected_events, clean_events)]
+
+    for name, value_column in (('calcium', 'Calcium Level'), ('arteriole', 'Arteriole Diameter')):
+        logging.info(f"Processing and saving {name} data")
+        with profile_stage(name):
+            with profile_stage('extract'):
+                extracted = windows(name)
+            time_event = _event_time_axis(streams[name][0], rates[name], bsline_length, event_length)
+            frames[name] = save_modality_windows(extracted, time_event, name, value_column, results_path, save_csv, plot_traces)
+
+    logging.info("Processing and saving whisker data")
+    with profile_stage('whisker'):
+        with profile_stage('extract'):
+            # Velocity samples from pairs of angle samples, NaN where either is outside the trace
+            baseline_size, event_size = window_sizes(rates['whisker'], bsline_length, event_length)
+            velocity_onsets = np.minimum(event_onsets(whisker_time, event_times, chunk_rows), max(len(whisker_time) - 1, 0))
+            starts = velocity_onsets - baseline_size
+            angle = gather_windows(whisker_angle, starts, baseline_size + event_size + 1)
+            time = gather_windows(whisker_time, starts, baseline_size + event_size + 1)
+            min_val, max_val = calibration['whisker_bounds']
+            velocity = (np.power(np.diff(angle, axis=1) / np.diff(time, axis=1), 2) - min_val) / (max_val - min_val)
+            whisker_windows = percent_change_from_baseline(velocity, baseline_size)
+        time_event = _event_time_axis(whisker_time, rates['whisker'], bsline_length, event_length)
+        frames['whisker'] = save_modality_windows(whisker_windows, time_event, 'whisker', 'Whisker Velocity', results_path, save_csv, plot_traces)
+
+    if save_csv:
+        with profile_stage('write_csv'):
+            for name in frames:
+                copy_windows_csv(results_path, name)
+
+    return {
+        'frames': frames,
+        'detected_events': detected_events,
+        'clean_events': clean_events,
+        'event_times': event_times,
+        'rates': rates,
+        'timing': timing,
+    }
@@ -1,22 +1,16 @@
 import os
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')  # Use a non-interactive backend
-
 import logging
-from src.data.data_loader import load_arteriole_data, load_calcium_data, load_pupil_data, load_whisker_data
-from src.utils.utilities import (
-    detect_and_interpolate_sudden_changes, normalize_mean_std, normalize_series,
-    moving_average, calculate_derivative,
-)
-from src.utils.processing import process_calcium_data, process_arteriole_data, process_whisker_data, process_pupil_data
-from src.utils.event_detection import detect_events
+from contextlib import nullcontext
+from src.utils.processing import process_calcium_data, process_arteriole_data, process_whisker_data, process_pupil_data, copy_windows_csv
+from src.utils.stages import compute_stages
+from src.utils.chunked import process_in_chunks
+from src.utils.profiling import PROFILE_FILE, profiling, profile_stage
+from src.utils.results_store import build_results, windows_from_frame, write_results
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_data(data_folder_path, threshold_to_exclude_from_min_max=1, threshold_to_exclude_base_on_pupil=2, plot_traces=False, save_trace_plot=True, clear_output=True, bsline_length=5, event_length=15, results_folder=None):
+def process_data(data_folder_path, threshold_to_exclude_from_min_max=1, threshold_to_exclude_base_on_pupil=2, plot_traces=False, save_trace_plot=True, clear_output=True, bsline_length=5, event_length=15, results_folder=None, use_cache=False, memo=False, profile=False, save_csv=True, store_format='npz', float_rates=False, whisker_rate=None, chunk_rows=None):
     try:
         if results_folder is None:
             raise ValueError("results_folder must be provided")
@@ -26,87 +20,38 @@ def process_data(data_folder_path, threshold_to_exclude_from_min_max=1, threshol
 
         logging.info(f"Processing data for folder: {data_folder_path}")
 
-        # Load data
-        logging.info("Loading arteriole data")
-        arteriole_data = load_arteriole_data(data_folder_path)
-
-        logging.info("Loading calcium data")
-        calcium_data = load_calcium_data(data_folder_path)
-
-        logging.info("Loading pupil data")
-        pupil_data = load_pupil_data(data_folder_path)
-
-        logging.info("Loading whisker data")
-        whisker_data = load_whisker_data(data_folder_path)
-
-        # Normalize and interpolate pupil data
-        logging.info("Normalizing and interpolating pupil data")
-        pupil_data_normalized = normalize_mean_std(pupil_data)
-        interpolated_pupil_data = detect_and_interpolate_sudden_changes(pupil_data_normalized, 0.001, 1)
-
-        # Calculate sampling rates
-        logging.info("Calculating sampling rates")
-        arteriole_sampling_rate = int(round(1 / np.mean(np.diff(arteriole_data['time']))))
-        calcium_sampling_rate = int(round(1 / np.mean(np.diff(calcium_data['time']))))
-        pupil_sampling_rate = int(round(1 / np.mean(np.diff(pupil_data['time']))))
-        whisker_sampling_rate = int(round(1 / np.mean(np.diff(whisker_data['time']))))
-
-        # Process pupil data
-        logging.info("Processing pupil data")
-        pupil_size_normalized = normalize_series(pupil_data['pupil_size'].values, threshold_to_exclude_from_min_max)
-        smoothed_pupil_size = moving_average(interpolated_pupil_data['pupil_size'], pupil_sampling_rate)
-        normalized_smoothed_pupil_size = normalize_series(smoothed_pupil_size, threshold_to_exclude_from_min_max)
-        smoothed_time_series = interpolated_pupil_data['time'].values[int(pupil_sampling_rate / 2) - 1:-int(pupil_sampling_rate / 2)][:smoothed_pupil_size.shape[0]]
-
-        # Detect events
-        logging.info("Detecting events")
-        whisker_time = whisker_data['time'].values
-        whisker_angle = whisker_data['whisker_angle'].values
-        normalized_whisker_velocity = normalize_series(np.power(calculate_derivative(whisker_angle, whisker_time), 2))
-        whisker_velocity_time = whisker_time[:-1]
-
-        waking_up_events = detect_events(normalized_smoothed_pupil_size, smoothed_time_series, normalized_whisker_velocity, whisker_velocity_time, pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length)
-
-        # Process and save data
-        logging.info("Processing and saving pupil data")
-        pupil_traces_df, clean_events = process_pupil_data(pupil_size_normalized, pupil_data['time'].values, smoothed_time_series, waking_up_events, results_path, pupil_sampling_rate, exclude_threshold=threshold_to_exclude_base_on_pupil, normalize=False, bsline_length=bsline_length, event_length=event_length)
-        pupil_traces_df.to_csv(os.path.join(results_path, 'pupil_traces.csv'), index=False)
-        waking_up_events = clean_events
-
-        logging.info("Processing and saving calcium data")
-        calcium_traces_df = process_calcium_data(calcium_data, smoothed_time_series, waking_up_events, results_path, calcium_sampling_rate, bsline_length=bsline_length, event_length=event_length)
-        calcium_traces_df.to_csv(os.path.join(results_path, 'calcium_traces.csv'), index=False)
-
-        logging.info("Processing and saving arteriole data")
-        arteriole_traces = process_arteriole_data(arteriole_data, smoothed_time_series, waking_up_events, results_path, arteriole_sampling_rate, bsline_length=bsline_length, event_length=event_length)
-        arteriole_traces.to_csv(os.path.join(results_path, 'arteriole_traces.csv'), index=False)
-
-        logging.info("Processing and saving whisker data")
-        whisker_traces = process_whisker_data(normalized_whisker_velocity, whisker_velocity_time, smoothed_time_series, waking_up_events, results_path, whisker_sampling_rate, bsline_length=bsline_length, event_length=event_length)
-        whisker_traces.to_csv(os.path.join(results_path, 'whisker_traces.csv'), index=False)
-
-        if save_trace_plot:
-            logging.info("Saving trace plots")
-            figure = plt.figure(figsize=(14, 8))
-            for col in pupil_traces_df.columns[1:]:
-                plt.plot(pupil_traces_df['Time (s)'], pupil_traces_df[col], label=col)
-                plt.legend()
-            figure.savefig(os.path.join(results_path, 'pupil_traces.png'))
-            plt.close(figure)
-
-            figure_2 = plt.figure(figsize=(14, 8))
-            for col in calcium_traces_df.columns[1:]:
-                plt.plot(calcium_traces_df['Time (s)'], calcium_traces_df[col], label=col)
-                plt.legend()
-            figure_2.savefig(os.path.join(results_path, 'calcium_traces.png'))
-            plt.close(figure_2)
-
-            figure_3 = plt.figure(figsize=(14, 8))
-            for col in arteriole_traces.columns[1:]:
-                plt.plot(arteriole_traces['Time (s)'], arteriole_traces[col], label=col)
-                plt.legend()
-            figure_3.savefig(os.path.join(results_path, 'arteriole_traces.png'))
-            plt.close(figure_3)
+        # profile=True writes per-stage wall time, CPU time and peak memory to profile.json
+        with profiling() if profile else nullcontext() as profiler:
+            with profile_stage('process_data'):
+                if chunk_rows is None:
+                    processed = _process_in_memory(data_folder_path, results_path, threshold_to_exclude_from_min_max, threshold_to_exclude_base_on_pupil, plot_traces, bsline_length, event_length, use_cache, memo, save_csv, float_rates, whisker_rate)
+                else:
+                    # Out-of-core for multi-hour recordings, the CSVs are read chunk_rows samples at a time
+                    processed = process_in_chunks(data_folder_path, results_path, threshold_to_exclude_from_min_max, threshold_to_exclude_base_on_pupil, plot_traces, bsline_length, event_length, save_csv, float_rates, whisker_rate, chunk_rows)
+                frames, rates, waking_up_events = processed['frames'], processed['rates'], processed['clean_events']
+
+                if store_format is not None:
+                    with profile_stage('write_store'):
+                        arrays, metadata = build_results(
+                            {modality: windows_from_frame(frame) for modality, frame in frames.items()},
+                            processed['detected_events'], waking_up_events, processed['event_times'],
+                            {'data_folder': data_folder_path, 'threshold_to_exclude_from_min_max': threshold_to_exclude_from_min_max,
+                             'threshold_to_exclude_base_on_pupil': threshold_to_exclude_base_on_pupil, 'bsline_length': bsline_length,
+                             'event_length': event_length, 'pupil_sampling_rate': rates['pupil'], 'calcium_sampling_rate': rates['calcium'],
+                             'arteriole_sampling_rate': rates['arteriole'], 'whisker_sampling_rate': rates['whisker'],
+                             'timing': processed['timing']})
+                        write_results(results_path, arrays, metadata, store_format)
+
+                if save_trace_plot:
+                    logging.info("Saving trace plots")
+                    with profile_stage('plot_traces'):
+                        from src.visualization.traces import save_traces_figure
+                        save_traces_figure(frames['pupil'], os.path.join(results_path, 'pupil_traces.png'))
+                        save_traces_figure(frames['calcium'], os.path.join(results_path, 'calcium_traces.png'))
+                        save_traces_figure(frames['arteriole'], os.path.join(results_path, 'arteriole_traces.png'))
+
+        if profile:
+            profiler.write_json(os.path.join(results_path, PROFILE_FILE), data_folder=data_folder_path, n_events=len(waking_up_events))
 
         if clear_output:
             from IPython.display import clear_output
@@ -116,4 +61,57 @@ def process_data(data_folder_path, threshold_to_exclude_from_min_max=1, threshol
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def _process_in_memory(data_folder_path, results_path, threshold_to_exclude_from_min_max, threshold_to_exclude_base_on_pupil, plot_traces, bsline_length, event_length, use_cache, memo, save_csv, float_rates, whisker_rate):
+    stages = compute_stages(data_folder_path, threshold_to_exclude_from_min_max, bsline_length, event_length, use_cache, memo, whisker_rate)
+    calcium_data, arteriole_data = stages['calcium_data'], stages['arteriole_data']
+    pupil_sampling_rate, calcium_sampling_rate = stages['pupil_sampling_rate'], stages['calcium_sampling_rate']
+    arteriole_sampling_rate, whisker_sampling_rate = stages['arteriole_sampling_rate'], stages['whisker_sampling_rate']
+    if float_rates:
+        # Windows sized from the measured median rates, e.g. 1.955 Hz imaging instead of 2 Hz
+        timing = stages['timing']
+        pupil_sampling_rate, calcium_sampling_rate = timing['pupil']['rate'], timing['calcium']['rate']
+        arteriole_sampling_rate, whisker_sampling_rate = timing['arteriole']['rate'], timing['whisker']['rate']
+    pupil_size_normalized, smoothed_time_series = stages['pupil_size_normalized'], stages['smoothed_time_series']
+    normalized_whisker_velocity, whisker_velocity_time = stages['normalized_whisker_velocity'], stages['whisker_velocity_time']
+    waking_up_events = stages['waking_up_events']
+
+    # Process and save data
+    logging.info("Processing and saving pupil data")
+    with profile_stage('pupil'):
+        pupil_traces_df, clean_events = process_pupil_data(pupil_size_normalized, stages['pupil_time'], smoothed_time_series, waking_up_events, results_path, pupil_sampling_rate, save_files=save_csv, exclude_threshold=threshold_to_exclude_base_on_pupil, normalize=False, bsline_length=bsline_length, event_length=event_length, plot=plot_traces)
+        if save_csv:
+            with profile_stage('write_csv'):
+                copy_windows_csv(results_path, 'pupil')
+    waking_up_events = clean_events
+
+    logging.info("Processing and saving calcium data")
+    with profile_stage('calcium'):
+        calcium_traces_df = process_calcium_data(calcium_data, smoothed_time_series, waking_up_events, results_path, calcium_sampling_rate, save_files=save_csv, bsline_length=bsline_length, event_length=event_length, plot=plot_traces)
+        if save_csv:
+            with profile_stage('write_csv'):
+                copy_windows_csv(results_path, 'calcium')
+
+    logging.info("Processing and saving arteriole data")
+    with profile_stage('arteriole'):
+        arteriole_traces = process_arteriole_data(arteriole_data, smoothed_time_series, waking_up_events, results_path, arteriole_sampling_rate, save_files=save_csv, bsline_length=bsline_length, event_length=event_length, plot=plot_traces)
+        if save_csv:
+            with profile_stage('write_csv'):
+                copy_windows_csv(results_path, 'arteriole')
+
+    logging.info("Processing and saving whisker data")
+    with profile_stage('whisker'):
+        whisker_traces = process_whisker_data(normalized_whisker_velocity, whisker_velocity_time, smoothed_time_series, waking_up_events, results_path, whisker_sampling_rate, save_files=save_csv, bsline_length=bsline_length, event_length=event_length, plot=plot_traces)
+        if save_csv:
+            with profile_stage('write_csv'):
+                copy_windows_csv(results_path, 'whisker')
+
+    return {
+        'frames': {'pupil': pupil_traces_df, 'calcium': calcium_traces_df, 'arteriole': arteriole_traces, 'whisker': whisker_traces},
+        'detected_events': stages['waking_up_events'],
+        'clean_events': waking_up_events,
+        'event_times': smoothed_time_series[waking_up_events],
+        'rates': {'pupil': pupil_sampling_rate, 'calcium': calcium_sampling_rate, 'arteriole': arteriole_sampling_rate, 'whisker': whisker_sampling_rate},
+        'timing': stages['timing'],
+    }
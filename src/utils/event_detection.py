@@ -1,49 +1,42 @@
 import numpy as np
 from src.utils.utilities import (
     detect_sudden_change_events, fill_false_between_trues,
-    find_consecutive_true_blocks, check_cross_midline, calculate_derivative, normalize_series
+    find_consecutive_true_blocks, calculate_derivative, normalize_series,
+    build_event_mask, blocks_cross_midline, block_ranges, whisker_integral_ratios,
 )
 from src.visualization.plotter import find_best_events
+from src.utils.profiling import profile_stage
+from src.utils.timebase import Timebase
 
 def detect_events(normalized_smoothed_pupil_size, smoothed_time_series, normalized_whisker_velocity, whisker_velocity_time, pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length):
     # Detect events
     pre_event_window = bsline_length * pupil_sampling_rate
     event_window = event_length * pupil_sampling_rate
-    events, event_indices = detect_sudden_change_events(normalized_smoothed_pupil_size, 5, pre_event_window, event_window, 3, 1)
-    mask = np.zeros(normalized_smoothed_pupil_size.shape)
+    with profile_stage('detect_sudden_change_events'):
+        events, event_indices = detect_sudden_change_events(normalized_smoothed_pupil_size, 5, pre_event_window, event_window, 3, 1)
+    with profile_stage('mask'):
+        mask = build_event_mask(event_indices, normalized_smoothed_pupil_size.shape[0], event_window + pre_event_window)
 
-    for idx, event_idx in enumerate(event_indices):
-        zero_array = np.zeros(normalized_smoothed_pupil_size.shape)
-        if event_idx == 1:
-            zero_array[idx:idx + event_window + pre_event_window] = 1
-        elif event_idx == 2:
-            zero_array[idx:idx + event_window + pre_event_window] = -1
-        mask += zero_array
+    with profile_stage('block_search'):
+        filled_mask = fill_false_between_trues(mask > 0.5, 10 * pupil_sampling_rate)
+        consecutive_blocks = find_consecutive_true_blocks(filled_mask, pupil_sampling_rate)
 
-    filled_mask = fill_false_between_trues(mask > 0.5, 10 * pupil_sampling_rate)
-    consecutive_blocks = find_consecutive_true_blocks(filled_mask, pupil_sampling_rate)
-
-    cross_midline_blocks = [block for block in consecutive_blocks if check_cross_midline(normalized_smoothed_pupil_size[block[0]:block[1]])]
-    final_ranges = [np.max(normalized_smoothed_pupil_size[block[0]:block[1]]) - np.min(normalized_smoothed_pupil_size[block[0]:block[1]]) for block in cross_midline_blocks]
-    final_blocks = [cross_midline_blocks[i] for i in range(len(cross_midline_blocks)) if final_ranges[i] > 0.5]
+        cross_midline_blocks = consecutive_blocks[blocks_cross_midline(normalized_smoothed_pupil_size, consecutive_blocks)]
+        final_ranges = block_ranges(normalized_smoothed_pupil_size, cross_midline_blocks)
+        final_blocks = cross_midline_blocks[final_ranges > 0.5]
 
     final_events = []
-    for block in final_blocks:
-        best_event = find_best_events(block, normalized_smoothed_pupil_size, smoothed_time_series, whisker_velocity_time, normalized_whisker_velocity, print_result=False, plot_result=False)
-        if best_event is not None:
-            final_events.append(best_event)
-
-    integral_data = []
-    for event in final_events:
-        time = smoothed_time_series[event]
-        event_whisker_idx = (whisker_velocity_time < time).sum()
-        baseline_whisker = normalized_whisker_velocity[event_whisker_idx - whisker_sampling_rate * bsline_length:event_whisker_idx]
-        waking_up_whisker = normalized_whisker_velocity[event_whisker_idx:event_whisker_idx + whisker_sampling_rate * event_length]
-        integral_baseline_whisker = np.trapz(baseline_whisker, whisker_velocity_time[event_whisker_idx - whisker_sampling_rate * bsline_length:event_whisker_idx]).mean()
-        integral_waking_up_whisker = np.trapz(waking_up_whisker, whisker_velocity_time[event_whisker_idx:event_whisker_idx + whisker_sampling_rate * event_length]).mean()
-        integral_ratio = integral_waking_up_whisker / integral_baseline_whisker
-        integral_data.append(integral_ratio)
-
-    waking_up_events = [event for idx, event in enumerate(final_events) if integral_data[idx] > 1.5]
+    with profile_stage('candidate_search'):
+        for block in final_blocks:
+            best_event = find_best_events(block, normalized_smoothed_pupil_size, smoothed_time_series, whisker_velocity_time, normalized_whisker_velocity, print_result=False, plot_result=False)
+            if best_event is not None:
+                final_events.append(best_event)
+
+    with profile_stage('whisker_filter'):
+        event_whisker_indices = Timebase(whisker_velocity_time).left_index(smoothed_time_series[np.asarray(final_events, dtype=int)])
+        integral_data = whisker_integral_ratios(event_whisker_indices, normalized_whisker_velocity, whisker_velocity_time,
+                                                whisker_sampling_rate, bsline_length, event_length)
+
+    waking_up_events = [event for event, integral_ratio in zip(final_events, integral_data) if integral_ratio > 1.5]
 
     return waking_up_events
\ No newline at end of file
@@ -1,9 +1,11 @@
 import numpy as np
 from src.utils.utilities import (
     detect_sudden_change_events, fill_false_between_trues,
-    find_consecutive_true_blocks, check_cross_midline, calculate_derivative, normalize_series
+    find_consecutive_true_blocks, calculate_derivative, normalize_series,
+    build_event_mask, blocks_cross_midline, block_ranges, whisker_integral_ratios,
 )
 from src.visualization.plotter import find_best_events
+from src.utils.timebase import Timebase
 
 def detect_events(normalized_smoothed_pupil_size, smoothed_time_series, whisker_time, whisker_angle, pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length):
     events = detect_pupil_events(normalized_smoothed_pupil_size, pupil_sampling_rate, bsline_length, event_length)
@@ -29,22 +31,16 @@ def detect_pupil_events(normalized_smoothed_pupil_size, pupil_sampling_rate, bsl
     return consecutive_blocks
 
 def create_event_mask(event_indices, shape, event_window, pre_event_window):
-    mask = np.zeros(shape)
-    for idx, event_idx in enumerate(event_indices):
-        zero_array = np.zeros(shape)
-        if event_idx == 1:
-            zero_array[idx:idx + event_window + pre_event_window] = 1
-        elif event_idx == 2:
-            zero_array[idx:idx + event_window + pre_event_window] = -1
-        mask += zero_array
-    return mask
+    return build_event_mask(event_indices, shape[0], event_window + pre_event_window)
 
 def filter_cross_midline_blocks(blocks, normalized_smoothed_pupil_size):
-    return [block for block in blocks if check_cross_midline(normalized_smoothed_pupil_size[block[0]:block[1]])]
+    blocks = np.asarray(blocks, dtype=int).reshape(-1, 2)
+    return blocks[blocks_cross_midline(normalized_smoothed_pupil_size, blocks)]
 
 def filter_final_blocks(cross_midline_blocks, normalized_smoothed_pupil_size):
-    final_ranges = [np.max(normalized_smoothed_pupil_size[block[0]:block[1]]) - np.min(normalized_smoothed_pupil_size[block[0]:block[1]]) for block in cross_midline_blocks]
-    return [cross_midline_blocks[i] for i in range(len(cross_midline_blocks)) if final_ranges[i] > 0.5]
+    cross_midline_blocks = np.asarray(cross_midline_blocks, dtype=int).reshape(-1, 2)
+    final_ranges = block_ranges(normalized_smoothed_pupil_size, cross_midline_blocks)
+    return cross_midline_blocks[final_ranges > 0.5]
 
 def calculate_normalized_whisker_velocity(whisker_angle, whisker_time):
     return normalize_series(np.power(calculate_derivative(whisker_angle, whisker_time), 2))
@@ -62,14 +58,5 @@ def filter_waking_up_events(events, normalized_whisker_velocity, smoothed_time_s
     return [event for idx, event in enumerate(events) if integral_data[idx] > 1.5]
 
 def calculate_integral_data(events, normalized_whisker_velocity, smoothed_time_series, whisker_time, whisker_sampling_rate, bsline_length, event_length):
-    integral_data = []
-    for event in events:
-        time = smoothed_time_series[event]
-        event_whisker_idx = (whisker_time < time).sum()
-        baseline_whisker = normalized_whisker_velocity[event_whisker_idx - whisker_sampling_rate * bsline_length:event_whisker_idx]
-        waking_up_whisker = normalized_whisker_velocity[event_whisker_idx:event_whisker_idx + whisker_sampling_rate * event_length]
-        integral_baseline_whisker = np.trapz(baseline_whisker, whisker_time[event_whisker_idx - whisker_sampling_rate * bsline_length:event_whisker_idx]).mean()
-        integral_waking_up_whisker = np.trapz(waking_up_whisker, whisker_time[event_whisker_idx:event_whisker_idx + whisker_sampling_rate * event_length]).mean()
-        integral_ratio = integral_waking_up_whisker / integral_baseline_whisker
-        integral_data.append(integral_ratio)
-    return integral_data
\ No newline at end of file
+    event_whisker_indices = Timebase(whisker_time).left_index(smoothed_time_series[np.asarray(events, dtype=int)])
+    return whisker_integral_ratios(event_whisker_indices, normalized_whisker_velocity, whisker_time, whisker_sampling_rate, bsline_length, event_length)
@@ -0,0 +1,110 @@
+# Smoothing kernels and percentile normalization for long traces. Short boxcar windows keep the
+# direct np.convolve of moving_average so existing results do not move; long windows switch to an
+# O(N) cumulative sum, and arbitrary long kernels to FFT convolution
+import numpy as np
+
+# Longest window or kernel still convolved directly
+DIRECT_MAX_WINDOW = 256
+BOXCAR_METHODS = ('auto', 'convolve', 'cumsum', 'fft')
+
+def valid_offset(window_size):
+    # Sample of the input a 'valid' output sample is aligned to: window [k, k + W) is reported at
+    # k + W // 2 - 1, the convention process_data has always used for the smoothed pupil time
+    return max(int(window_size / 2) - 1, 0)
+
+def fft_convolve(data, kernel, mode='full'):
+    # np.convolve through real FFTs, O(N log N) whatever the kernel length
+    data, kernel = np.asarray(data, dtype=float), np.asarray(kernel, dtype=float)
+    n_full = data.shape[0] + kernel.shape[0] - 1
+    n_fft = 1 << max(n_full - 1, 0).bit_length()
+    full = np.fft.irfft(np.fft.rfft(data, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)[:n_full]
+    if mode == 'full':
+        return full
+    if mode == 'valid':
+        short, long = sorted((data.shape[0], kernel.shape[0]))
+        return full[short - 1:long]
+    if mode == 'same':
+        long = max(data.shape[0], kernel.shape[0])
+        start = (n_full - long) // 2
+        return full[start:start + long]
+    raise ValueError(f"Unknown convolution mode: {mode}")
+
+def convolve(data, kernel, mode='valid', method='auto'):
+    # np.convolve semantics, FFT-based for kernels longer than DIRECT_MAX_WINDOW
+    if method == 'auto':
+        method = 'fft' if np.asarray(kernel).shape[0] > DIRECT_MAX_WINDOW else 'direct'
+    if method == 'direct':
+        return np.convolve(data, kernel, mode=mode)
+    if method == 'fft':
+        return fft_convolve(data, kernel, mode)
+    raise ValueError(f"Unknown convolution method: {method}")
+
+def _boxcar_valid(data, window_size, method):
+    if method == 'auto':
+        method = 'cumsum' if window_size > DIRECT_MAX_WINDOW else 'convolve'
+    if method == 'convolve':
+        return np.convolve(data, np.ones(window_size) / window_size, mode='valid')
+    if method == 'fft':
+        return fft_convolve(data, np.ones(window_size) / window_size, mode='valid')
+    if method == 'cumsum':
+        # Centred on the mean so the running sum stays small over multi-hour traces
+        reference = data.mean() if data.shape[0] else 0.0
+        running = np.concatenate([[0.0], np.cumsum(data - reference)])
+        return (running[window_size:] - running[:-window_size]) / window_size + reference
+    raise ValueError(f"Unknown boxcar method: {method}")
+
+def boxcar(data, window_size, mode='valid', method='auto'):
+    # Moving average over window_size samples. 'valid' is moving_average; 'same' keeps the input
+    # length, output i averaging data[i - valid_offset(W):i - valid_offset(W) + W] clipped to the
+    # trace, so interior samples equal the 'valid' output aligned by valid_offset
+    data = np.asarray(data, dtype=float)
+    if window_size == 0:
+        return data
+    if window_size > data.shape[0]:
+        valid = np.empty(0)
+    else:
+        valid = _boxcar_valid(data, window_size, method)
+    if mode == 'valid':
+        return valid
+    if mode != 'same':
+        raise ValueError(f"Unknown boxcar mode: {mode}")
+
+    offset = valid_offset(window_size)
+    starts = np.clip(np.arange(data.shape[0]) - offset, 0, data.shape[0])
+    stops = np.clip(np.arange(data.shape[0]) - offset + window_size, 0, data.shape[0])
+    running = np.concatenate([[0.0], np.cumsum(data)])
+    same = (running[stops] - running[starts]) / np.maximum(stops - starts, 1)
+    same[offset:offset + valid.shape[0]] = valid
+    return same
+
+def smooth_trace(values, time, window_size, mode='valid', method='auto'):
+    # Moving average of a trace together with the time vector its samples are aligned to
+    smoothed = boxcar(values, window_size, mode, method)
+    time = np.asarray(time)
+    if mode == 'same' or window_size == 0:
+        return smoothed, time
+    offset = valid_offset(window_size)
+    return smoothed, time[offset:offset + smoothed.shape[0]]
+
+def percentile_bounds(series, threshold=1):
+    # The threshold and 100 - threshold percentiles from a single partition of the data
+    min_val, max_val = np.percentile(series, [threshold, 100 - threshold])
+    return min_val, max_val
+
+class PercentileNormalizer:
+    # normalize_series with its bounds cached per threshold, for data normalized repeatedly
+    # e.g. across a sweep of thresholds or when several arrays share one reference trace
+    def __init__(self, reference):
+        self.reference = np.asarray(reference)
+        self._bounds = {}
+
+    def bounds(self, threshold=1):
+        if threshold not in self._bounds:
+            self._bounds[threshold] = percentile_bounds(self.reference, threshold)
+        return self._bounds[threshold]
+
+    def __call__(self, series=None, threshold=1):
+        # Normalizes series, the reference itself by default, with the reference's bounds
+        min_val, max_val = self.bounds(threshold)
+        series = self.reference if series is None else series
+        return (series - min_val) / (max_val - min_val)
@@ -0,0 +1,82 @@
+# Per-folder result manifests used to skip cycles whose inputs and parameters did not change
+import os
+import json
+import inspect
+import hashlib
+from src.utils.data_processing import process_data
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+# process_data keywords that do not change which files it writes or what they contain. Every
+# other keyword, including ones added later, is recorded and compared when skipping unchanged folders
+RUNTIME_PARAMETERS = ('data_folder_path', 'results_folder', 'plot_traces', 'clear_output', 'use_cache', 'memo')
+MANIFEST_PARAMETERS = tuple(name for name in inspect.signature(process_data).parameters if name not in RUNTIME_PARAMETERS)
+
+def manifest_path(results_folder):
+    return os.path.join(results_folder, MANIFEST_FILE)
+
+def file_sha256(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def describe_input(file_path, with_hash=True):
+    stat = os.stat(file_path)
+    description = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        description['sha256'] = file_sha256(file_path)
+    return description
+
+def list_input_files(data_folder_path):
+    return sorted(name for name in os.listdir(data_folder_path) if name.endswith('.csv'))
+
+def manifest_parameters(params):
+    return {name: params[name] for name in MANIFEST_PARAMETERS if name in params}
+
+def build_manifest(data_folder_path, params):
+    return {
+        'version': MANIFEST_VERSION,
+        'data_folder': os.path.abspath(data_folder_path),
+        'inputs': {name: describe_input(os.path.join(data_folder_path, name)) for name in list_input_files(data_folder_path)},
+        'parameters': manifest_parameters(params),
+    }
+
+def write_manifest(results_folder, data_folder_path, params):
+    manifest = build_manifest(data_folder_path, params)
+    tmp_path = manifest_path(results_folder) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path(results_folder))
+    return manifest
+
+def load_manifest(results_folder):
+    try:
+        with open(manifest_path(results_folder)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def inputs_unchanged(data_folder_path, recorded_inputs):
+    names = list_input_files(data_folder_path)
+    if names != sorted(recorded_inputs):
+        return False
+
+    for name in names:
+        recorded = recorded_inputs[name]
+        current = describe_input(os.path.join(data_folder_path, name), with_hash=False)
+        if current['size'] != recorded['size']:
+            return False
+        # Only hash files whose mtime moved, e.g. after a copy or touch
+        if current['mtime_ns'] != recorded['mtime_ns'] and file_sha256(os.path.join(data_folder_path, name)) != recorded['sha256']:
+            return False
+    return True
+
+def is_unchanged(data_folder_path, results_folder, params):
+    manifest = load_manifest(results_folder)
+    if manifest is None or manifest.get('version') != MANIFEST_VERSION:
+        return False
+    if manifest.get('parameters') != manifest_parameters(params):
+        return False
+    return inputs_unchanged(data_folder_path, manifest.get('inputs', {}))
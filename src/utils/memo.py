@@ -0,0 +1,212 @@
+# Content-addressed memoization of pipeline stages: results are keyed on a hash of the
+# stage name, the code it runs, its input arrays and its parameters, kept in a byte-budgeted
+# LRU in memory and optionally pickled to disk
+import os
+import sys
+import types
+import pickle
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from src.data.mmap_loader import LinearTimeAxis
+
+MEMO_VERSION = 1
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+def _update_digest(digest, value):
+    if isinstance(value, np.ndarray):
+        digest.update(f'ndarray:{value.dtype.str}:{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).data if value.dtype != object else repr(value.tolist()).encode())
+    elif isinstance(value, pd.DataFrame):
+        digest.update(f'DataFrame:{list(map(str, value.columns))}'.encode())
+        _update_digest(digest, value.index.to_numpy())
+        for column in value.columns:
+            _update_digest(digest, value[column].to_numpy())
+    elif isinstance(value, pd.Series):
+        digest.update(f'Series:{value.name}'.encode())
+        _update_digest(digest, value.index.to_numpy())
+        _update_digest(digest, value.to_numpy())
+    elif isinstance(value, dict):
+        digest.update(f'dict:{len(value)}'.encode())
+        for key in sorted(value, key=str):
+            _update_digest(digest, key)
+            _update_digest(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}:{len(value)}'.encode())
+        for item in value:
+            _update_digest(digest, item)
+    elif value is None or isinstance(value, (bool, int, float, str, bytes, np.generic)):
+        digest.update(f'{type(value).__name__}:{value!r}'.encode())
+    elif isinstance(value, LinearTimeAxis):
+        # Fully described by its parameters, hashed without generating the samples
+        digest.update(f'LinearTimeAxis:{value.n_samples}:{value.start!r}:{value.stop!r}:{value.length}'.encode())
+    elif hasattr(value, '__array__'):
+        _update_digest(digest, np.asarray(value))
+    else:
+        raise TypeError(f"Cannot hash a {type(value).__name__} for the memo cache")
+
+_fingerprints = {}
+
+def _is_pipeline_code(value):
+    return (getattr(value, '__module__', None) or getattr(value, '__name__', '')).startswith('src.')
+
+def _walk_code(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _walk_code(const)
+
+def _const_repr(const):
+    # Set literals are stored as frozensets, whose repr order changes with the hash seed
+    if isinstance(const, frozenset):
+        return f'frozenset({sorted(map(_const_repr, const))})'
+    if isinstance(const, tuple):
+        return f'({", ".join(map(_const_repr, const))})'
+    return repr(const)
+
+def code_fingerprint(function):
+    # Hash of the bytecode of function and of every function, method and constant of the
+    # pipeline it reaches through its globals, so editing any code a stage runs changes its keys
+    if function in _fingerprints:
+        return _fingerprints[function]
+    digest = hashlib.blake2b(digest_size=20)
+    pending, seen = [function], set()
+    while pending:
+        current = pending.pop()
+        if isinstance(current, type):
+            pending.extend(value for _, value in sorted(vars(current).items()) if callable(value) or isinstance(value, property))
+            continue
+        if isinstance(current, property):
+            pending.extend(accessor for accessor in (current.fget, current.fset) if accessor is not None)
+            continue
+        current = getattr(current, '__func__', current)
+        if not isinstance(current, types.FunctionType) or current.__code__ in seen:
+            continue
+        seen.add(current.__code__)
+        digest.update(f'{current.__module__}.{current.__qualname__}'.encode())
+        for code in _walk_code(current.__code__):
+            digest.update(code.co_code)
+            digest.update(_const_repr(tuple(const for const in code.co_consts if not isinstance(const, types.CodeType))).encode())
+            for name in code.co_names:
+                value = current.__globals__.get(name)
+                if isinstance(value, types.ModuleType):
+                    if _is_pipeline_code(value):
+                        pending.extend(member for _, member in sorted(vars(value).items())
+                                       if isinstance(member, (types.FunctionType, type)) and member.__module__ == value.__name__)
+                elif isinstance(value, (types.FunctionType, type)):
+                    if _is_pipeline_code(value):
+                        pending.append(value)
+                elif isinstance(value, (bool, int, float, str, tuple)):
+                    digest.update(f'{name}={value!r}'.encode())
+    _fingerprints[function] = digest.hexdigest()
+    return _fingerprints[function]
+
+def content_key(stage, function, *args, **kwargs):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{MEMO_VERSION}:{stage}:{code_fingerprint(function)}'.encode())
+    _update_digest(digest, args)
+    _update_digest(digest, kwargs)
+    return digest.hexdigest()
+
+def estimate_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+class MemoCache:
+    # Returned values are shared between callers and must be treated as read-only
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.disk_dir is not None and os.path.exists(self._disk_path(key)))
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.pkl')
+
+    def _remember(self, key, value):
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        if self.disk_dir is not None:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return default
+            self.disk_hits += 1
+            self._remember(key, value)
+            return value
+        return default
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f"Could not write memo entry {key}: {e}")
+
+    def call(self, stage, function, *args, **kwargs):
+        key = content_key(stage, function, *args, **kwargs)
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            self.misses += 1
+            value = function(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+_default_cache = None
+
+def default_memo_cache():
+    # Process-wide memory-only cache used by process_data(memo=True)
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MemoCache()
+    return _default_cache
+
+def run_stage(memo, stage, function, *args, **kwargs):
+    # memo=None or False runs the stage directly
+    if memo is None or memo is False:
+        return function(*args, **kwargs)
+    return memo.call(stage, function, *args, **kwargs)
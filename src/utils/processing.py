@@ -1,190 +1,123 @@
+import shutil
 import numpy as np
 import pandas as pd
-from scipy.stats import sem
-import matplotlib
-matplotlib.use('Agg')  # Use a non-interactive backend
-
-import matplotlib.pyplot as plt
 from pathlib import Path
-
-def process_calcium_data(calcium, smoothed_times, final_events, save_path, calcium_sampling_rate, normalize=True, save_files=True, event_length=15, bsline_length=5):
-    calcium_data = calcium['calcium'].values
-    calcium_time = calcium['time'].values
-    windows = []
-
-    for event in final_events:
-        time = smoothed_times[event]
-        event_calcium_idx = (calcium_time < time).sum()
-        window = calcium_data[event_calcium_idx - calcium_sampling_rate*bsline_length:event_calcium_idx + calcium_sampling_rate*event_length]
-        baseline = calcium_data[event_calcium_idx - calcium_sampling_rate*bsline_length:event_calcium_idx]
-        if normalize:
-            window = 100 * (window - np.mean(baseline)) / np.mean(baseline)
-        windows.append(window)
-
-    time_event = calcium_time[0:calcium_sampling_rate*(event_length + bsline_length)] - bsline_length
-
-    for window in windows:
-        plt.plot(time_event, window)
-    plt.title("Calcium Data Windows")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Calcium Level")
-    plt.show()
-
-    mean_window = np.mean(windows, axis=0)
-    ci = 1.96 * sem(windows, axis=0)
-
-    plt.plot(time_event, mean_window, label='Mean')
-    plt.fill_between(time_event, mean_window - ci, mean_window + ci, color='b', alpha=0.2, label='95% CI')
-    plt.title("Average Calcium Data Window with 95% CI")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Calcium Level")
-    plt.legend()
-    plt.show()
-
-    calcium_mean_df = pd.DataFrame({'Time (s)': time_event, 'Calcium Level': mean_window})
-    if save_files:
-        calcium_mean_df.to_csv(Path(save_path) / 'calcium_mean.csv', index=False)
-
-    calcium_windows_df = pd.DataFrame(windows).T
-    calcium_windows_df.insert(0, 'Time (s)', time_event)
-    if save_files:
-        calcium_windows_df.to_csv(Path(save_path) / 'calcium_windows.csv', index=False)
-    return calcium_windows_df
-
-def process_arteriole_data(arteriole_diameter, smoothed_times, final_events, save_path, arteriole_sampling_rate, normalize=True, save_files=True, bsline_length=5, event_length=15):
-    arteriole_data = arteriole_diameter['arteriole_diameter'].values
-    arteriole_time = arteriole_diameter['time'].values
-    windows = []
-
-    for event in final_events:
-        time = smoothed_times[event]
-        event_arteriole_idx = (arteriole_time < time).sum()
-        window = arteriole_data[event_arteriole_idx - arteriole_sampling_rate*bsline_length:event_arteriole_idx + arteriole_sampling_rate*event_length]
-        baseline = arteriole_data[event_arteriole_idx - arteriole_sampling_rate*bsline_length:event_arteriole_idx]
-        if normalize:
-            window = 100 * (window - np.mean(baseline)) / np.mean(baseline)
-        windows.append(window)
-
-    time_event = arteriole_time[0:arteriole_sampling_rate*(event_length + bsline_length)] - bsline_length
-
-    for window in windows:
-        plt.plot(time_event, window)
-    plt.title("Arteriole Diameter Data Windows")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Arteriole Diameter")
-    plt.show()
-
-    mean_window = np.mean(windows, axis=0)
-    ci = 1.96 * sem(windows, axis=0)
-
-    plt.plot(time_event, mean_window, label='Mean')
-    plt.fill_between(time_event, mean_window - ci, mean_window + ci, color='b', alpha=0.2, label='95% CI')
-    plt.title("Average Arteriole Diameter Data Window with 95% CI")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Arteriole Diameter")
-    plt.legend()
-    plt.show()
-
-    arteriole_mean_df = pd.DataFrame({'Time (s)': time_event, 'Arteriole Diameter': mean_window})
-
-    if save_files:
-        arteriole_mean_df.to_csv(Path(save_path) / 'arteriole_mean.csv', index=False)
-
-    arteriole_windows_df = pd.DataFrame(windows).T
-    arteriole_windows_df.insert(0, 'Time (s)', time_event)
-    if save_files:
-        arteriole_windows_df.to_csv(Path(save_path) / 'arteriole_windows.csv', index=False)
-
-    return arteriole_windows_df
-
-def process_whisker_data(normalized_whisker_velocity, whisker_time, smoothed_times, final_events, save_path, whisker_sampling_rate, save_files=True, normalize=True, bsline_length=5, event_length=15):
-    windows_whisker = []
-    time_event_whisker = whisker_time[0:(bsline_length + event_length) * whisker_sampling_rate] - bsline_length
-
-    for event in final_events:
-        time = smoothed_times[event]
-        event_whisker_idx = (whisker_time < time).sum()
-        window = normalized_whisker_velocity[event_whisker_idx - bsline_length * whisker_sampling_rate:event_whisker_idx + event_length * whisker_sampling_rate]
-        baseline = normalized_whisker_velocity[event_whisker_idx - bsline_length * whisker_sampling_rate:event_whisker_idx]
-        if normalize:
-            window = 100 * (window - np.mean(baseline)) / np.mean(baseline)
-        windows_whisker.append(window)
-
-    mean_window_whisker = np.mean(windows_whisker, axis=0)
-    ci_whisker = 1.96 * sem(windows_whisker, axis=0)
-
-    for window in windows_whisker:
-        plt.plot(time_event_whisker, window)
-    plt.title("Whisker Velocity Data Windows")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Whisker Velocity")
-    plt.yscale('log')
-    plt.show()
-
-    plt.plot(time_event_whisker, mean_window_whisker, label='Mean')
-    plt.fill_between(time_event_whisker, mean_window_whisker - ci_whisker, mean_window_whisker + ci_whisker, color='b', alpha=0.2, label='95% CI')
-    plt.title("Average Whisker Velocity Data Window with 95% CI")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Whisker Velocity")
-    plt.yscale('log')
-    plt.legend()
-    plt.show()
-
-    whisker_mean_df = pd.DataFrame({'Time (s)': time_event_whisker, 'Whisker Velocity': mean_window_whisker})
+from numpy.lib.stride_tricks import sliding_window_view
+from src.utils.profiling import profile_stage
+from src.utils.timebase import Timebase
+from src.utils.timing import window_sizes
+
+def event_sample_indices(time, event_times):
+    # (time < t).sum() for each event, without a full scan per event
+    return Timebase(time).left_index(event_times)
+
+def gather_windows(values, starts, window_size):
+    # (events x samples) matrix of values[start:start + window_size] for every start, samples falling
+    # outside the recording are NaN. Only the windowed samples are read, so values may be a memmap
+    n_values = len(values)
+    if starts.shape[0] == 0:
+        return np.empty((0, window_size))
+    if isinstance(values, np.ndarray) and starts.min() >= 0 and starts.max() + window_size <= n_values:
+        return np.asarray(sliding_window_view(values, window_size)[starts], dtype=float)
+    positions = starts[:, None] + np.arange(window_size)[None, :]
+    inside = (positions >= 0) & (positions < n_values)
+    windows = np.full(positions.shape, np.nan)
+    windows[inside] = values[positions[inside]]
+    return windows
+
+def percent_change_from_baseline(windows, baseline_size):
+    # Samples padded for events near the edges are ignored, as in summarize_windows and
+    # exclude_outlier_events; only a baseline entirely outside the recording gives a NaN row
+    baseline = windows[:, :baseline_size]
+    if np.isnan(baseline).any():
+        counts = np.sum(~np.isnan(baseline), axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            baseline_mean = np.nansum(baseline, axis=1, keepdims=True) / counts
+    else:
+        baseline_mean = np.mean(baseline, axis=1, keepdims=True)
+    return 100 * (windows - baseline_mean) / baseline_mean
+
+def extract_event_windows(time, values, sampling_rate, event_times, bsline_length=5, event_length=15, normalize=True):
+    # (events x samples) matrix of values[idx - baseline:idx + event] around every event,
+    # samples falling outside the recording are NaN
+    values = np.asarray(values, dtype=float)
+    baseline_size, event_size = window_sizes(sampling_rate, bsline_length, event_length)
+    starts = event_sample_indices(time, np.asarray(event_times, dtype=float)) - baseline_size
+    windows = gather_windows(values, starts, baseline_size + event_size)
+    if normalize:
+        windows = percent_change_from_baseline(windows, baseline_size)
+    return windows
+
+def event_time_axis(time, sampling_rate, bsline_length=5, event_length=15):
+    # Same number of samples as the windows of extract_event_windows, also for float rates
+    return time[0:sum(window_sizes(sampling_rate, bsline_length, event_length))] - bsline_length
+
+def summarize_windows(windows):
+    # Mean and 95% CI across events, ignoring samples padded for events near the edges
+    from scipy.stats import sem
+    if np.isnan(windows).any():
+        return np.nanmean(windows, axis=0), 1.96 * np.asarray(sem(windows, axis=0, nan_policy='omit'))
+    return np.mean(windows, axis=0), 1.96 * sem(windows, axis=0)
+
+def exclude_outlier_events(windows, events, exclude_threshold):
+    # Drop events whose pupil trace is dominated by outliers, judged on the samples inside the recording
+    events = np.asarray(events, dtype=int)
+    if windows.shape[0] == 0:
+        return windows, events
+    keep = ~((np.nanpercentile(windows, 80, axis=1) > exclude_threshold) | (np.nanpercentile(windows, 20, axis=1) < -exclude_threshold))
+    return windows[keep], events[keep]
+
+def save_modality_windows(windows, time_event, modality, value_column, save_path, save_files=True, plot=False):
+    # Mean trace and per-event windows of one modality as <modality>_mean.csv and <modality>_windows.csv
+    mean_window, ci = summarize_windows(windows)
+    if plot:
+        with profile_stage('plot'):
+            from src.visualization.traces import plot_modality
+            plot_modality(time_event, windows, modality, mean_window, ci)
+
+    mean_df = pd.DataFrame({'Time (s)': time_event, value_column: mean_window})
     if save_files:
-        whisker_mean_df.to_csv(Path(save_path) / 'whisker_mean.csv', index=False)
+        with profile_stage('write_csv'):
+            mean_df.to_csv(Path(save_path) / f'{modality}_mean.csv', index=False)
 
-    whisker_windows_df = pd.DataFrame(windows_whisker).T
-    whisker_windows_df.insert(0, 'Time (s)', time_event_whisker)
+    windows_df = pd.DataFrame(windows).T
+    windows_df.insert(0, 'Time (s)', time_event)
     if save_files:
-        whisker_windows_df.to_csv(Path(save_path) / 'whisker_windows.csv', index=False)
-
-    return whisker_windows_df
-
-def process_pupil_data(pupil_size, pupil_time, smoothed_times_series, final_events, save_path, pupil_sampling_rate, exclude_threshold=6, save_files=True, normalize=True, event_length=15, bsline_length=5):
-    windows_pupil = []
-    clean_events = []
-    for event in final_events:
-        time = smoothed_times_series[event]
-        event_pupil_idx = (pupil_time < time).sum()
-        window = pupil_size[event_pupil_idx - pupil_sampling_rate * bsline_length:event_pupil_idx + pupil_sampling_rate * event_length]
-        baseline = pupil_size[event_pupil_idx - pupil_sampling_rate * bsline_length:event_pupil_idx]
-        if normalize:
-            window = 100 * (window - np.mean(baseline)) / np.mean(baseline)
-
-        if (np.percentile(window, 80) > exclude_threshold) or (np.percentile(window, 20) < -exclude_threshold):
-            continue
-
-        clean_events.append(event)
-        windows_pupil.append(window)
-
-    time_event_pupil = pupil_time[0:pupil_sampling_rate * (event_length + bsline_length)] - bsline_length
-
-    for window in windows_pupil:
-        plt.plot(time_event_pupil, window)
-    plt.title("Pupil Size Data Windows")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Pupil Size")
-    plt.show()
-
-    mean_window_pupil = np.mean(windows_pupil, axis=0)
-    ci_pupil = 1.96 * sem(windows_pupil, axis=0)
-
-    plt.plot(time_event_pupil, mean_window_pupil, label='Mean')
-    plt.fill_between(time_event_pupil, mean_window_pupil - ci_pupil, mean_window_pupil + ci_pupil, color='b', alpha=0.2, label='95% CI')
-    plt.title("Average Pupil Size Data Window with 95% CI")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Pupil Size")
-    plt.legend()
-    plt.show()
-
-    pupil_mean_df = pd.DataFrame({'Time (s)': time_event_pupil, 'Pupil Size': mean_window_pupil})
-    if save_files:
-        pupil_mean_df.to_csv(Path(save_path) / 'pupil_mean.csv', index=False)
+        with profile_stage('write_csv'):
+            windows_df.to_csv(Path(save_path) / f'{modality}_windows.csv', index=False)
+    return windows_df
 
-    pupil_windows_df = pd.DataFrame(windows_pupil).T
-    pupil_windows_df.insert(0, 'Time (s)', time_event_pupil)
-    if save_files:
-        pupil_windows_df.to_csv(Path(save_path) / 'pupil_windows.csv', index=False)
+def process_calcium_data(calcium, smoothed_times, final_events, save_path, calcium_sampling_rate, normalize=True, save_files=True, event_length=15, bsline_length=5, plot=False):
+    calcium_time = calcium['time'].values
+    with profile_stage('extract'):
+        windows = extract_event_windows(calcium_time, calcium['calcium'].values, calcium_sampling_rate, smoothed_times[np.asarray(final_events, dtype=int)], bsline_length, event_length, normalize)
+    time_event = event_time_axis(calcium_time, calcium_sampling_rate, bsline_length, event_length)
+    return save_modality_windows(windows, time_event, 'calcium', 'Calcium Level', save_path, save_files, plot)
 
-    return pupil_windows_df, clean_events
\ No newline at end of file
+def process_arteriole_data(arteriole_diameter, smoothed_times, final_events, save_path, arteriole_sampling_rate, normalize=True, save_files=True, bsline_length=5, event_length=15, plot=False):
+    arteriole_time = arteriole_diameter['time'].values
+    with profile_stage('extract'):
+        windows = extract_event_windows(arteriole_time, arteriole_diameter['arteriole_diameter'].values, arteriole_sampling_rate, smoothed_times[np.asarray(final_events, dtype=int)], bsline_length, event_length, normalize)
+    time_event = event_time_axis(arteriole_time, arteriole_sampling_rate, bsline_length, event_length)
+    return save_modality_windows(windows, time_event, 'arteriole', 'Arteriole Diameter', save_path, save_files, plot)
+
+def process_whisker_data(normalized_whisker_velocity, whisker_time, smoothed_times, final_events, save_path, whisker_sampling_rate, save_files=True, normalize=True, bsline_length=5, event_length=15, plot=False):
+    with profile_stage('extract'):
+        windows_whisker = extract_event_windows(whisker_time, normalized_whisker_velocity, whisker_sampling_rate, smoothed_times[np.asarray(final_events, dtype=int)], bsline_length, event_length, normalize)
+    time_event_whisker = event_time_axis(whisker_time, whisker_sampling_rate, bsline_length, event_length)
+    return save_modality_windows(windows_whisker, time_event_whisker, 'whisker', 'Whisker Velocity', save_path, save_files, plot)
+
+def process_pupil_data(pupil_size, pupil_time, smoothed_times_series, final_events, save_path, pupil_sampling_rate, exclude_threshold=6, save_files=True, normalize=True, event_length=15, bsline_length=5, plot=False):
+    final_events = np.asarray(final_events, dtype=int)
+    with profile_stage('extract'):
+        windows_pupil = extract_event_windows(pupil_time, pupil_size, pupil_sampling_rate, smoothed_times_series[final_events], bsline_length, event_length, normalize)
+
+    windows_pupil, final_events = exclude_outlier_events(windows_pupil, final_events, exclude_threshold)
+    clean_events = final_events.tolist()
+
+    time_event_pupil = event_time_axis(pupil_time, pupil_sampling_rate, bsline_length, event_length)
+    return save_modality_windows(windows_pupil, time_event_pupil, 'pupil', 'Pupil Size', save_path, save_files, plot), clean_events
+
+def copy_windows_csv(results_path, modality):
+    # <modality>_traces.csv holds the same table as <modality>_windows.csv, copy it rather than format it again
+    shutil.copyfile(Path(results_path) / f'{modality}_windows.csv', Path(results_path) / f'{modality}_traces.csv')
@@ -0,0 +1,155 @@
+# Per-stage wall time, CPU time and peak traced memory of the processing pipeline.
+# Code marks its stages with profile_stage(name); nothing is recorded unless a
+# StageProfiler is active, so the markers cost almost nothing in normal runs
+import os
+import json
+import time
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+PROFILE_FILE = 'profile.json'
+
+class _Frame:
+    def __init__(self, path, start_memory):
+        self.path = path
+        self.start_memory = start_memory
+        self.peak_memory = start_memory
+
+class StageProfiler:
+    # Nested stages are recorded under 'parent/child' paths, repeated stages accumulate
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = {}
+        self._stack = []
+        self._started_tracing = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        path = f'{self._stack[-1].path}/{name}' if self._stack else name
+        start_memory = 0
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # The parent's peak so far is lost by the reset below
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, peak)
+            tracemalloc.reset_peak()
+            start_memory = current
+        frame = _Frame(path, start_memory)
+        self._stack.append(frame)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            if self.trace_memory and tracemalloc.is_tracing():
+                frame.peak_memory = max(frame.peak_memory, tracemalloc.get_traced_memory()[1])
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1].peak_memory = max(self._stack[-1].peak_memory, frame.peak_memory)
+            self._record(path, wall_time, cpu_time, frame.peak_memory - frame.start_memory)
+
+    def _record(self, path, wall_time, cpu_time, peak_memory):
+        record = self.records.setdefault(path, {'stage': path, 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_memory_bytes': 0})
+        record['calls'] += 1
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time
+        record['peak_memory_bytes'] = max(record['peak_memory_bytes'], int(peak_memory))
+
+    def to_dict(self, **metadata):
+        return {**metadata, 'trace_memory': self.trace_memory, 'stages': list(self.records.values())}
+
+    def write_json(self, file_path, **metadata):
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(**metadata), f, indent=2)
+        os.replace(tmp_path, file_path)
+
+_active_profiler = None
+
+@contextmanager
+def profiling(trace_memory=True):
+    # Activates a StageProfiler for the enclosed code and yields it
+    global _active_profiler
+    previous = _active_profiler
+    profiler = StageProfiler(trace_memory)
+    _active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profiler = previous
+
+@contextmanager
+def profile_stage(name):
+    if _active_profiler is None:
+        yield
+        return
+    with _active_profiler.stage(name):
+        yield
+
+def profiled(name):
+    # Decorator form of profile_stage
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load_profiles(results_folders):
+    # Tidy (folder, stage, ...) table of the profile.json files that exist
+    rows = []
+    for results_folder in results_folders:
+        try:
+            with open(os.path.join(results_folder, PROFILE_FILE)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for record in profile['stages']:
+            rows.append({'results_folder': results_folder, **record})
+    return pd.DataFrame(rows, columns=['results_folder', 'stage', 'calls', 'wall_time', 'cpu_time', 'peak_memory_bytes'])
+
+def summarize_profiles(profiles):
+    # Per-stage statistics across cycles, slowest stages first
+    if profiles.empty:
+        return pd.DataFrame(columns=['stage', 'cycles', 'wall_mean', 'wall_median', 'wall_max', 'slowest_cycle', 'cpu_mean', 'peak_memory_max_mb'])
+    grouped = profiles.groupby('stage', sort=False)
+    summary = pd.DataFrame({
+        'cycles': grouped['wall_time'].size(),
+        'wall_mean': grouped['wall_time'].mean(),
+        'wall_median': grouped['wall_time'].median(),
+        'wall_max': grouped['wall_time'].max(),
+        'slowest_cycle': profiles.loc[grouped['wall_time'].idxmax(), 'results_folder'].values,
+        'cpu_mean': grouped['cpu_time'].mean(),
+        'peak_memory_max_mb': grouped['peak_memory_bytes'].max() / 1024 ** 2,
+    })
+    return summary.sort_values('wall_mean', ascending=False).reset_index()
+
+def format_profile_report(profiles, top_cycles=5):
+    summary = summarize_profiles(profiles)
+    lines = [f"{'Stage':<48}  {'Cycles':>6}  {'Mean (s)':>9}  {'Median (s)':>10}  {'Max (s)':>8}  {'CPU (s)':>8}  {'Peak (MB)':>9}"]
+    lines.append('-' * len(lines[0]))
+    for row in summary.itertuples(index=False):
+        lines.append(f"{row.stage:<48}  {row.cycles:>6}  {row.wall_mean:>9.3f}  {row.wall_median:>10.3f}  {row.wall_max:>8.3f}  {row.cpu_mean:>8.3f}  {row.peak_memory_max_mb:>9.1f}")
+
+    totals = profiles[profiles['stage'] == 'process_data'].sort_values('wall_time', ascending=False)
+    if not totals.empty:
+        lines.append('')
+        lines.append('Slowest cycles:')
+        for row in totals.head(top_cycles).itertuples(index=False):
+            lines.append(f"  {row.results_folder}  {row.wall_time:.3f} s")
+    return '\n'.join(lines)
@@ -0,0 +1,93 @@
+# One compressed file per processed cycle holding every modality's event windows, their time
+# axes, the event indices and the run parameters, as a faster alternative to the per-modality CSVs
+import os
+import json
+import numpy as np
+import pandas as pd
+
+RESULTS_STEM = 'results'
+RESULTS_VERSION = 1
+STORE_FORMATS = ('npz', 'hdf5')
+MODALITIES = ('pupil', 'calcium', 'arteriole', 'whisker')
+
+def h5py_available():
+    try:
+        import h5py  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def results_path(results_folder, store_format='npz'):
+    return os.path.join(results_folder, f"{RESULTS_STEM}.{'h5' if store_format == 'hdf5' else 'npz'}")
+
+def find_results_file(results_folder):
+    # The store written to results_folder, npz preferred, or None
+    for store_format in STORE_FORMATS:
+        file_path = results_path(results_folder, store_format)
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+def windows_from_frame(windows_df):
+    # (time axis, events x samples matrix) of a window DataFrame as returned by the process_* functions
+    return windows_df['Time (s)'].to_numpy(dtype=float), windows_df.iloc[:, 1:].to_numpy(dtype=float).T
+
+def windows_frame(time_event, windows):
+    # Inverse of windows_from_frame: one column per event after the 'Time (s)' column
+    windows_df = pd.DataFrame(np.asarray(windows).T)
+    windows_df.insert(0, 'Time (s)', time_event)
+    return windows_df
+
+def build_results(modality_windows, detected_events, clean_events, event_times, parameters):
+    # modality_windows: {modality: (time axis, windows)}; returns the flat arrays of a store
+    arrays = {
+        'detected_events': np.asarray(detected_events, dtype=np.int64),
+        'clean_events': np.asarray(clean_events, dtype=np.int64),
+        'event_times': np.asarray(event_times, dtype=float),
+    }
+    for modality, (time_event, windows) in modality_windows.items():
+        arrays[f'{modality}_time'] = np.asarray(time_event, dtype=float)
+        arrays[f'{modality}_windows'] = np.asarray(windows, dtype=float).reshape(-1, np.asarray(time_event).shape[0])
+    metadata = {'version': RESULTS_VERSION, 'modalities': list(modality_windows), 'parameters': parameters}
+    return arrays, metadata
+
+def write_results(results_folder, arrays, metadata, store_format='npz'):
+    if store_format not in STORE_FORMATS:
+        raise ValueError(f"Unknown results store format: {store_format}")
+    file_path = results_path(results_folder, store_format)
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    if store_format == 'npz':
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, metadata=np.array(json.dumps(metadata)), **arrays)
+    else:
+        if not h5py_available():
+            raise ImportError("The hdf5 results store needs h5py")
+        import h5py
+        with h5py.File(tmp_path, 'w') as f:
+            f.attrs['metadata'] = json.dumps(metadata)
+            for name, values in arrays.items():
+                f.create_dataset(name, data=values, compression='gzip', shuffle=True)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+def load_results(results_folder_or_file):
+    # Reads a whole store in one go: {'parameters', 'modalities', <array name>: array, ...}
+    file_path = results_folder_or_file
+    if os.path.isdir(file_path):
+        file_path = find_results_file(file_path)
+        if file_path is None:
+            raise FileNotFoundError(f"No results store in {results_folder_or_file}")
+
+    if file_path.endswith('.h5'):
+        import h5py
+        with h5py.File(file_path, 'r') as f:
+            metadata = json.loads(f.attrs['metadata'])
+            arrays = {name: f[name][()] for name in f.keys()}
+    else:
+        with np.load(file_path) as f:
+            metadata = json.loads(str(f['metadata']))
+            arrays = {name: f[name] for name in f.files if name != 'metadata'}
+
+    if metadata.get('version') != RESULTS_VERSION:
+        raise ValueError(f"{file_path} has results store version {metadata.get('version')}, expected {RESULTS_VERSION}")
+    return {'parameters': metadata['parameters'], 'modalities': metadata['modalities'], **arrays}
@@ -0,0 +1,66 @@
+# Vectorized rolling-window statistics used by the sudden change detector
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+CHUNK_SIZE = 8192
+
+def window_starts(signal_length, pre_event_window, event_window, step=1):
+    return np.arange(0, max(signal_length - pre_event_window - event_window, 0), step)
+
+def rolling_window_stats(signal, pre_event_window, event_window, step=1, method='window', chunk_size=CHUNK_SIZE):
+    signal = np.asarray(signal, dtype=float)
+    n_windows = len(window_starts(len(signal), pre_event_window, event_window, step))
+    if n_windows == 0:
+        empty = np.empty(0)
+        return empty, empty.copy(), empty.copy()
+
+    if method == 'window':
+        return _window_stats(signal, pre_event_window, event_window, step, n_windows, chunk_size)
+    if method == 'cumsum':
+        return _cumsum_stats(signal, pre_event_window, event_window, step, n_windows)
+    raise ValueError(f"Unknown rolling statistics method: {method}")
+
+def _window_stats(signal, pre_event_window, event_window, step, n_windows, chunk_size):
+    # Strided views reduce every row exactly like np.mean/np.std on the slice,
+    # chunking the rows keeps the std temporaries bounded for long recordings
+    baseline_view = sliding_window_view(signal, pre_event_window)[::step][:n_windows]
+    event_view = sliding_window_view(signal[pre_event_window:], event_window)[::step][:n_windows]
+
+    baseline_mean = np.empty(n_windows)
+    baseline_std = np.empty(n_windows)
+    event_mean = np.empty(n_windows)
+    for start in range(0, n_windows, chunk_size):
+        stop = min(start + chunk_size, n_windows)
+        baseline_rows = baseline_view[start:stop]
+        baseline_mean[start:stop] = baseline_rows.mean(axis=1)
+        baseline_std[start:stop] = baseline_rows.std(axis=1)
+        event_mean[start:stop] = event_view[start:stop].mean(axis=1)
+
+    return baseline_mean, baseline_std, event_mean
+
+def _cumsum_stats(signal, pre_event_window, event_window, step, n_windows):
+    # O(N) prefix sums on the centered signal, equal to the window method up to rounding
+    offset = signal.mean()
+    centered = signal - offset
+    csum = np.concatenate([[0.0], np.cumsum(centered)])
+    csum_sq = np.concatenate([[0.0], np.cumsum(centered * centered)])
+
+    starts = np.arange(n_windows) * step
+    baseline_sum = csum[starts + pre_event_window] - csum[starts]
+    baseline_sum_sq = csum_sq[starts + pre_event_window] - csum_sq[starts]
+    event_sum = csum[starts + pre_event_window + event_window] - csum[starts + pre_event_window]
+
+    baseline_mean = baseline_sum / pre_event_window
+    baseline_var = np.maximum(baseline_sum_sq / pre_event_window - baseline_mean ** 2, 0)
+    event_mean = event_sum / event_window
+
+    return baseline_mean + offset, np.sqrt(baseline_var), event_mean + offset
+
+def classify_sudden_changes(baseline_mean, baseline_std, event_mean, threshold=3):
+    # 0: no change, 1: increase, 2: decrease
+    delta = event_mean - baseline_mean
+    limit = baseline_std * threshold
+    classification = np.zeros(delta.shape, dtype=np.int8)
+    classification[delta < -limit] = 2
+    classification[delta > limit] = 1
+    return classification
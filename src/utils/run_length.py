@@ -0,0 +1,24 @@
+# Run-length encoding primitives for boolean masks and label arrays
+import numpy as np
+
+def run_length_encode(values):
+    values = np.asarray(values)
+    n = values.shape[0]
+    if n == 0:
+        empty = np.empty(0, dtype=int)
+        return empty, empty.copy(), values[:0]
+
+    boundaries = np.flatnonzero(np.diff(values.astype(np.int8) if values.dtype == bool else values) != 0) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [n]])
+    return starts, ends, values[starts]
+
+def run_lengths(starts, ends):
+    return ends - starts
+
+def run_length_decode(starts, ends, values):
+    return np.repeat(values, run_lengths(starts, ends))
+
+def true_runs(mask):
+    starts, ends, values = run_length_encode(np.asarray(mask, dtype=bool))
+    return starts[values], ends[values]
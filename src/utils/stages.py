@@ -0,0 +1,110 @@
+# Named stages of process_data. Each stage takes arrays and parameters and returns plain
+# values, so it can be memoized on the content of its inputs and reused by other callers
+import logging
+import numpy as np
+from src.data.data_loader import load_arteriole_data, load_calcium_data, load_pupil_data, load_whisker_data
+from src.data.mmap_loader import LinearTimeAxis, load_whisker_mmap
+from src.utils.utilities import (
+    detect_and_interpolate_sudden_changes, normalize_mean_std, normalize_series, calculate_derivative,
+)
+from src.utils.filtering import smooth_trace
+from src.utils.event_detection import detect_events
+from src.utils.memo import default_memo_cache, run_stage
+from src.utils.profiling import profile_stage
+from src.utils.timing import stream_timing, integer_rate, check_timing
+
+STAGES = ('load', 'interpolate', 'whisker_velocity', 'smooth', 'detect')
+
+def load_stage(data_folder_path, use_cache=False, whisker_rate=None):
+    logging.info("Loading arteriole data")
+    arteriole_data = load_arteriole_data(data_folder_path, use_cache=use_cache)
+
+    logging.info("Loading calcium data")
+    calcium_data = load_calcium_data(data_folder_path, use_cache=use_cache)
+
+    logging.info("Loading pupil data")
+    pupil_data = load_pupil_data(data_folder_path, use_cache=use_cache)
+
+    logging.info("Loading whisker data")
+    if use_cache:
+        # Read-only memory map of the angle column, time generated from the sampling rate
+        whisker_angle, whisker_time = load_whisker_mmap(data_folder_path, sampling_rate=whisker_rate)
+    else:
+        whisker_data = load_whisker_data(data_folder_path, sampling_rate=whisker_rate)
+        whisker_angle, whisker_time = whisker_data['whisker_angle'].values, whisker_data['time'].values
+
+    logging.info("Calculating sampling rates")
+    # Computed once per load and carried with the data, float rates and jitter included
+    timing = {
+        'arteriole': stream_timing(arteriole_data['time'].values),
+        'calcium': stream_timing(calcium_data['time'].values),
+        'pupil': stream_timing(pupil_data['time'].values),
+        'whisker': stream_timing(whisker_time),
+    }
+    check_timing(timing)
+    return {
+        'arteriole_data': arteriole_data,
+        'calcium_data': calcium_data,
+        'pupil_data': pupil_data,
+        'whisker_angle': whisker_angle,
+        'whisker_time': whisker_time,
+        'timing': timing,
+        'arteriole_sampling_rate': integer_rate(timing['arteriole']),
+        'calcium_sampling_rate': integer_rate(timing['calcium']),
+        'pupil_sampling_rate': integer_rate(timing['pupil']),
+        'whisker_sampling_rate': integer_rate(timing['whisker']),
+    }
+
+def interpolate_stage(pupil_data):
+    # Median/std normalization and blink removal of the raw pupil trace
+    pupil_data_normalized = normalize_mean_std(pupil_data.copy())
+    return {
+        'pupil_size': pupil_data_normalized['pupil_size'].values,
+        'pupil_time': pupil_data_normalized['time'].values,
+        'interpolated_pupil_data': detect_and_interpolate_sudden_changes(pupil_data_normalized, 0.001, 1),
+    }
+
+def whisker_velocity_stage(whisker_angle, whisker_time):
+    return {
+        'normalized_whisker_velocity': normalize_series(np.power(calculate_derivative(whisker_angle, whisker_time), 2)),
+        'whisker_velocity_time': whisker_time.head(len(whisker_time) - 1) if isinstance(whisker_time, LinearTimeAxis) else whisker_time[:-1],
+    }
+
+def smooth_stage(interpolated, pupil_sampling_rate, threshold_to_exclude_from_min_max):
+    interpolated_pupil_data = interpolated['interpolated_pupil_data']
+    smoothed_pupil_size, smoothed_time_series = smooth_trace(interpolated_pupil_data['pupil_size'].values, interpolated_pupil_data['time'].values, pupil_sampling_rate)
+    return {
+        'pupil_size_normalized': normalize_series(interpolated['pupil_size'], threshold_to_exclude_from_min_max),
+        'normalized_smoothed_pupil_size': normalize_series(smoothed_pupil_size, threshold_to_exclude_from_min_max),
+        'smoothed_time_series': smoothed_time_series,
+    }
+
+def detect_stage(normalized_smoothed_pupil_size, smoothed_time_series, normalized_whisker_velocity, whisker_velocity_time,
+                 pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length):
+    return np.asarray(detect_events(normalized_smoothed_pupil_size, smoothed_time_series, normalized_whisker_velocity, whisker_velocity_time,
+                                    pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length), dtype=int)
+
+def compute_stages(data_folder_path, threshold_to_exclude_from_min_max=1, bsline_length=5, event_length=15, use_cache=False, memo=False, whisker_rate=None):
+    # Everything process_data derives before writing results. memo=False recomputes every stage,
+    # memo=True uses the process-wide memo cache and a MemoCache is used as given. whisker_rate=None
+    # spans the whisker trace over the 900 s cycle, longer recordings need the rate it was resampled at
+    memo = default_memo_cache() if memo is True else memo
+    with profile_stage('load'):
+        loaded = load_stage(data_folder_path, use_cache, whisker_rate)
+
+    logging.info("Normalizing and interpolating pupil data")
+    with profile_stage('interpolate'):
+        interpolated = run_stage(memo, 'interpolate', interpolate_stage, loaded['pupil_data'])
+
+    logging.info("Processing pupil data")
+    with profile_stage('smooth'):
+        smoothed = run_stage(memo, 'smooth', smooth_stage, interpolated, loaded['pupil_sampling_rate'], threshold_to_exclude_from_min_max)
+    with profile_stage('whisker_velocity'):
+        whisker = run_stage(memo, 'whisker_velocity', whisker_velocity_stage, loaded['whisker_angle'], loaded['whisker_time'])
+
+    logging.info("Detecting events")
+    with profile_stage('detect'):
+        events = run_stage(memo, 'detect', detect_stage, smoothed['normalized_smoothed_pupil_size'], smoothed['smoothed_time_series'],
+                           whisker['normalized_whisker_velocity'], whisker['whisker_velocity_time'],
+                           loaded['pupil_sampling_rate'], loaded['whisker_sampling_rate'], bsline_length, event_length)
+    return {**loaded, **interpolated, **whisker, **smoothed, 'waking_up_events': events}
@@ -0,0 +1,486 @@
+# Incremental waking-up event detection for live acquisition.
+# Pupil and whisker samples are pushed in chunks; every stage of detect_events runs on
+# bounded buffers and an event is emitted once its whisker response window is complete.
+import numpy as np
+from src.data.data_loader import load_pupil_data, load_whisker_data
+from src.utils.rolling import rolling_window_stats, classify_sudden_changes
+from src.utils.run_length import run_length_encode
+from src.utils.timing import stream_timing, integer_rate
+from src.utils.filtering import percentile_bounds
+from src.utils.utilities import (
+    blink_interval_mask, blocks_cross_midline, block_ranges, calculate_properties_possible_events,
+    select_best_candidate, detect_and_interpolate_sudden_changes, normalize_mean_std,
+    moving_average, calculate_derivative,
+)
+
+PADDING = 5  # edge padding used by detect_events
+FILL_GAP_SECONDS = 10
+TAIL_SECONDS = 5
+CANDIDATE_BASELINE_SECONDS = 5  # baseline_window of calculate_properties_possible_events
+CANDIDATE_EVENT_SECONDS = 15  # event_window of calculate_properties_possible_events
+
+class RingBuffer:
+    # Circular buffer addressed by absolute sample index, grows when a long block needs more history
+    def __init__(self, capacity=1024, dtype=float):
+        self._data = np.empty(max(int(capacity), 1), dtype=dtype)
+        self.start = 0
+        self.stop = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        if len(self) + values.shape[0] > self._data.shape[0]:
+            self._resize(max(len(self) + values.shape[0], 2 * self._data.shape[0]))
+        self._data[np.arange(self.stop, self.stop + values.shape[0]) % self._data.shape[0]] = values
+        self.stop += values.shape[0]
+
+    def _resize(self, capacity):
+        kept = self[self.start:self.stop]
+        self._data = np.empty(capacity, dtype=self._data.dtype)
+        self._data[np.arange(self.start, self.stop) % capacity] = kept
+
+    def __getitem__(self, key):
+        start, stop = key.start, key.stop
+        if not self.start <= start <= stop <= self.stop:
+            raise IndexError(f"samples [{start}, {stop}) are outside the buffered range [{self.start}, {self.stop})")
+        return self._data[np.arange(start, stop) % self._data.shape[0]]
+
+    def last(self):
+        return self._data[(self.stop - 1) % self._data.shape[0]]
+
+    def discard_before(self, index):
+        self.start = max(self.start, min(int(index), self.stop))
+
+class P2Quantile:
+    # Jain & Chlamtac P-square estimate of one quantile in O(1) memory
+    def __init__(self, q):
+        self.q = q
+        self._initial = []
+        self._heights = None
+
+    def update(self, values):
+        for x in np.asarray(values, dtype=float).ravel():
+            if not np.isnan(x):
+                self._update_one(x)
+
+    def _update_one(self, x):
+        if self._heights is None:
+            self._initial.append(x)
+            if len(self._initial) == 5:
+                q = self.q
+                self._heights = sorted(self._initial)
+                self._positions = [1.0, 2.0, 3.0, 4.0, 5.0]
+                self._desired = [1.0, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5.0]
+                self._increments = [0.0, q / 2, q, (1 + q) / 2, 1.0]
+            return
+
+        h, n = self._heights, self._positions
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if h[i] <= x < h[i + 1])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1.0 if d > 0 else -1.0
+                parabolic = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+                )
+                if h[i - 1] < parabolic < h[i + 1]:
+                    h[i] = parabolic
+                else:
+                    j = i + int(d)
+                    h[i] = h[i] + d * (h[j] - h[i]) / (n[j] - n[i])
+                n[i] += d
+
+    @property
+    def value(self):
+        if self._heights is None:
+            return np.percentile(self._initial, 100 * self.q) if self._initial else np.nan
+        return self._heights[2]
+
+def calibrate_from_recording(pupil_data, whisker_time, whisker_angle, pupil_sampling_rate,
+                             threshold_to_exclude_from_min_max=1, blink_quantile=0.001, blink_window=1):
+    # Normalization constants exactly as process_data derives them from a whole recording
+    pupil_size = pupil_data['pupil_size']
+    center, scale = pupil_size.median(), pupil_size.std()
+    normalized = normalize_mean_std(pupil_data.copy())
+    blink_threshold = normalized['pupil_size'].diff().quantile(blink_quantile)
+    interpolated = detect_and_interpolate_sudden_changes(normalized, blink_quantile, blink_window)
+    smoothed = moving_average(interpolated['pupil_size'], pupil_sampling_rate)
+    whisker_power = np.power(calculate_derivative(whisker_angle, whisker_time), 2)
+    return {
+        'pupil_center': center,
+        'pupil_scale': scale,
+        'blink_threshold': blink_threshold,
+        'pupil_bounds': percentile_bounds(smoothed, threshold_to_exclude_from_min_max),
+        'whisker_bounds': percentile_bounds(whisker_power, 1),
+    }
+
+class StreamingEventDetector:
+    # Without a calibration the blink threshold and the normalization bounds are running
+    # P-square estimates and the first warmup_seconds of pupil are held back until they settle.
+    # With calibrate_from_recording of the same file the emitted events match detect_events
+    def __init__(self, pupil_sampling_rate, whisker_sampling_rate, bsline_length=5, event_length=15,
+                 threshold_to_exclude_from_min_max=1, calibration=None, blink_quantile=0.001, blink_window=1,
+                 warmup_seconds=60):
+        self.pupil_sampling_rate = pupil_sampling_rate
+        self.whisker_sampling_rate = whisker_sampling_rate
+        self.bsline_length = bsline_length
+        self.event_length = event_length
+        self.pre_event_window = bsline_length * pupil_sampling_rate
+        self.event_window = event_length * pupil_sampling_rate
+        self.span = self.pre_event_window + self.event_window
+        self.smoothing_window = pupil_sampling_rate
+        self.fill_gap = FILL_GAP_SECONDS * pupil_sampling_rate
+        self.blink_window = blink_window
+        self.calibration = calibration
+        self.warmup_samples = 0 if calibration is not None else int(warmup_seconds * pupil_sampling_rate)
+
+        if calibration is None:
+            self._blink_estimate = P2Quantile(blink_quantile)
+            self._pupil_estimates = (P2Quantile(threshold_to_exclude_from_min_max / 100), P2Quantile(1 - threshold_to_exclude_from_min_max / 100))
+            self._whisker_estimates = (P2Quantile(0.01), P2Quantile(0.99))
+
+        history = 4 * (self.span + self.fill_gap)
+        self._raw_time, self._raw_value, self._raw_change = RingBuffer(history), RingBuffer(history), RingBuffer(history)
+        self._last_raw_value = np.nan
+        self._drop_intervals = np.empty((0, 2))
+        self._clean_time, self._clean_value = RingBuffer(history), RingBuffer(history)
+        self._y, self._y_time = RingBuffer(history), RingBuffer(history)
+        self._coverage = RingBuffer(history)
+        self._n_masked = 0
+        self._open_start = None
+        self._last_true = None
+        self._gap = 0
+        self._seen_true = False
+        self._pending_blocks = []
+        self._pending_events = []
+        self._whisker_time, self._whisker_velocity = RingBuffer(history), RingBuffer(history)
+        self._last_whisker = None
+        self._emitted = []
+        self._n_drained = 0
+        self.finished = False
+
+    # Public interface
+
+    def push_pupil(self, time, pupil_size):
+        time, pupil_size = self._valid(time, pupil_size)
+        if time.shape[0]:
+            self._push_raw_pupil(time, pupil_size)
+            self._finalize_raw(final=False)
+        self._advance(final=False)
+        return self._drain()
+
+    def push_whisker(self, time, whisker_angle):
+        time, whisker_angle = self._valid(time, whisker_angle)
+        if time.shape[0]:
+            self._push_whisker(time, whisker_angle)
+        self._evaluate_events(final=False)
+        self._trim()
+        return self._drain()
+
+    def finish(self):
+        self._finalize_raw(final=True)
+        self._advance(final=True)
+        self.finished = True
+        return self._drain()
+
+    @property
+    def events(self):
+        return list(self._emitted)
+
+    # Pupil stages
+
+    @staticmethod
+    def _valid(time, values):
+        time, values = np.asarray(time, dtype=float).ravel(), np.asarray(values, dtype=float).ravel()
+        valid = ~(np.isnan(time) | np.isnan(values))
+        return time[valid], values[valid]
+
+    def _push_raw_pupil(self, time, pupil_size):
+        if self.calibration is None:
+            normalized = pupil_size
+        else:
+            normalized = (pupil_size - self.calibration['pupil_center']) / self.calibration['pupil_scale']
+
+        change = np.diff(np.concatenate([[self._last_raw_value], normalized]))
+        if self.calibration is None:
+            self._blink_estimate.update(change)
+
+        self._raw_time.extend(time)
+        self._raw_value.extend(normalized)
+        self._raw_change.extend(change)
+        self._last_raw_value = normalized[-1]
+
+    def _finalize_raw(self, final):
+        # A sample is final once no later drop can reach back to it
+        start, stop = self._raw_time.start, self._raw_time.stop
+        if start == stop or (not final and stop < self.warmup_samples):
+            return
+        times = self._raw_time[start:stop]
+        n_final = times.shape[0] if final else int(np.searchsorted(times, times[-1] - self.blink_window, side='left'))
+        if n_final == 0:
+            return
+
+        threshold = self._blink_estimate.value if self.calibration is None else self.calibration['blink_threshold']
+        drop_times = times[self._raw_change[start:stop] < threshold]
+        pending_intervals = np.column_stack([drop_times - self.blink_window, drop_times + self.blink_window])
+        intervals = np.concatenate([self._drop_intervals, pending_intervals])
+
+        final_times, final_values = times[:n_final], self._raw_value[start:start + n_final]
+        removed = blink_interval_mask(final_times, intervals)
+        for buffer in (self._raw_time, self._raw_value, self._raw_change):
+            buffer.discard_before(start + n_final)
+
+        # Drops of finalized samples still reach forward into the pending ones
+        if n_final < times.shape[0]:
+            final_intervals = pending_intervals[:np.searchsorted(drop_times, times[n_final], side='left')]
+            self._drop_intervals = np.concatenate([self._drop_intervals, final_intervals])
+            self._drop_intervals = self._drop_intervals[self._drop_intervals[:, 1] >= times[n_final]]
+        else:
+            self._drop_intervals = self._drop_intervals[:0]
+
+        self._push_clean(final_times[~removed], final_values[~removed])
+
+    def _push_clean(self, time, values):
+        self._clean_time.extend(time)
+        self._clean_value.extend(values)
+
+        window = self.smoothing_window
+        next_index, n_clean = self._y.stop, self._clean_value.stop
+        if n_clean - window + 1 <= next_index:
+            return
+        smoothed = moving_average(self._clean_value[next_index:n_clean], window)
+        time_offset = int(window / 2) - 1
+        smoothed_time = self._clean_time[next_index + time_offset:next_index + time_offset + smoothed.shape[0]]
+
+        if self.calibration is None:
+            for estimate in self._pupil_estimates:
+                estimate.update(smoothed)
+            min_val, max_val = (estimate.value for estimate in self._pupil_estimates)
+        else:
+            min_val, max_val = self.calibration['pupil_bounds']
+
+        self._y.extend((smoothed - min_val) / (max_val - min_val))
+        self._y_time.extend(smoothed_time)
+        self._clean_time.discard_before(self._y.stop)
+        self._clean_value.discard_before(self._y.stop)
+
+    def _padded(self, start, stop):
+        # Samples of the trace padded with PADDING copies of its first (and, once final, last) value
+        n_y = self._y.stop
+        indices = np.clip(np.arange(start, stop) - PADDING, 0, n_y - 1)
+        lo = int(indices.min())
+        return self._y[lo:int(indices.max()) + 1][indices - lo]
+
+    def _classify(self, final):
+        n_y = self._y.stop
+        if n_y == 0:
+            return
+        n_padded = n_y + PADDING + (PADDING if final else 0)
+        stop = n_padded - self.span
+        start = self._coverage.stop
+        if stop <= start:
+            return
+
+        signal = self._padded(start, stop + self.span)
+        baseline_mean, baseline_std, event_mean = rolling_window_stats(signal, self.pre_event_window, self.event_window)
+        classification = classify_sudden_changes(baseline_mean, baseline_std, event_mean, 3)
+        self._coverage.extend(np.where(classification == 1, 1.0, np.where(classification == 2, -1.0, 0.0)))
+
+    def _mask(self, final):
+        # Coverage mask of detect_events for every sample whose windows are all classified
+        n_y = self._y.stop
+        start = self._n_masked
+        stop = n_y if final else min(self._coverage.stop, n_y)
+        if stop <= start:
+            return
+
+        first = max(start - self.span + 1, 0)
+        classified_stop = min(stop, self._coverage.stop)
+        values = np.zeros(stop - first)
+        values[:classified_stop - first] = self._coverage[first:classified_stop]
+        csum = np.concatenate([[0.0], np.cumsum(values)])
+        indices = np.arange(start, stop)
+        coverage = csum[indices - first + 1] - csum[np.maximum(indices - self.span + 1, 0) - first]
+
+        self._n_masked = stop
+        self._track_blocks(coverage > 0.5, start)
+
+    def _track_blocks(self, mask, offset):
+        # fill_false_between_trues + find_consecutive_true_blocks over runs as they arrive
+        starts, ends, values = run_length_encode(mask)
+        for start, end, value in zip(starts + offset, ends + offset, values):
+            if value:
+                if self._open_start is None:
+                    leading_gap_filled = not self._seen_true and start <= self.fill_gap
+                    self._open_start = 0 if leading_gap_filled else int(start)
+                self._seen_true = True
+                self._last_true = int(end) - 1
+                self._gap = 0
+            else:
+                self._gap += int(end - start)
+                if self._open_start is not None and self._gap > self.fill_gap:
+                    self._pending_blocks.append((self._open_start, self._last_true))
+                    self._open_start = None
+
+    def _close_final_block(self):
+        n_y = self._y.stop
+        if n_y == 0:
+            return
+        if self._open_start is None and not self._seen_true and n_y <= self.fill_gap:
+            self._open_start = 0
+        if self._open_start is not None:
+            start = self._open_start
+            self._pending_blocks.append((min(start, abs(start - TAIL_SECONDS * self.pupil_sampling_rate)), n_y - 1))
+            self._open_start = None
+
+    def _evaluate_blocks(self, final):
+        n_y = self._y.stop
+        while self._pending_blocks:
+            start, end = self._pending_blocks[0]
+            time_step = np.mean(np.diff(self._y_time[start:end]))
+            if not final and n_y < end - 1 + int(CANDIDATE_EVENT_SECONDS / time_step):
+                break
+            self._pending_blocks.pop(0)
+
+            base = max(start - int(CANDIDATE_BASELINE_SECONDS / time_step), 0) if end - start > 1 else start
+            signal, time = self._y[base:n_y], self._y_time[base:n_y]
+            block = np.array([[start - base, end - base]])
+            if not blocks_cross_midline(signal, block)[0] or not block_ranges(signal, block)[0] > 0.5:
+                continue
+
+            properties = calculate_properties_possible_events((start - base, end - base), signal, time)
+            _, best = select_best_candidate(properties)
+            if best is not None:
+                index = start + int(best['idx'])
+                self._pending_events.append({'index': index, 'time': float(self._y_time[index:index + 1][0])})
+
+    # Whisker stages
+
+    def _push_whisker(self, time, whisker_angle):
+        if self._last_whisker is not None:
+            time = np.concatenate([[self._last_whisker[0]], time])
+            whisker_angle = np.concatenate([[self._last_whisker[1]], whisker_angle])
+        self._last_whisker = (time[-1], whisker_angle[-1])
+        if time.shape[0] < 2:
+            return
+
+        power = np.power(np.diff(whisker_angle) / np.diff(time), 2)
+        if self.calibration is None:
+            for estimate in self._whisker_estimates:
+                estimate.update(power)
+            min_val, max_val = (estimate.value for estimate in self._whisker_estimates)
+        else:
+            min_val, max_val = self.calibration['whisker_bounds']
+
+        self._whisker_time.extend(time[:-1])
+        self._whisker_velocity.extend((power - min_val) / (max_val - min_val))
+
+    def _evaluate_events(self, final):
+        baseline_size = self.whisker_sampling_rate * self.bsline_length
+        response_size = self.whisker_sampling_rate * self.event_length
+        while self._pending_events:
+            event = self._pending_events[0]
+            buffered_start, n_velocity = self._whisker_time.start, self._whisker_time.stop
+            if not final and (n_velocity == 0 or self._whisker_time.last() < event['time']):
+                break
+            times = self._whisker_time[buffered_start:n_velocity]
+            index = buffered_start + int(np.searchsorted(times, event['time'], side='left'))
+            if not final and n_velocity < index + response_size:
+                break
+            self._pending_events.pop(0)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # A baseline reaching before the first sample is an empty slice in detect_events
+                if index - baseline_size >= buffered_start:
+                    baseline = np.trapz(self._whisker_velocity[index - baseline_size:index], self._whisker_time[index - baseline_size:index])
+                else:
+                    baseline = np.float64(0.0)
+                stop = min(index + response_size, n_velocity)
+                response = np.trapz(self._whisker_velocity[index:stop], self._whisker_time[index:stop])
+                ratio = response / baseline
+
+            if ratio > 1.5:
+                event['integral_ratio'] = float(ratio)
+                self._emitted.append(event)
+
+    # Bookkeeping
+
+    def _advance(self, final):
+        self._classify(final)
+        self._mask(final)
+        if final:
+            self._close_final_block()
+        self._evaluate_blocks(final)
+        self._evaluate_events(final)
+        self._trim()
+
+    def _trim(self):
+        # Keep only what pending and future blocks can still reach
+        needed = [self._n_masked, self._coverage.stop - PADDING]
+        if self._open_start is not None:
+            needed.append(self._open_start)
+        if not self._seen_true:
+            needed.append(0)
+        needed += [start for start, _ in self._pending_blocks]
+        needed += [event['index'] for event in self._pending_events]
+        margin = (TAIL_SECONDS + 2 * CANDIDATE_BASELINE_SECONDS) * self.pupil_sampling_rate
+        keep_from = max(min(needed) - margin, 0)
+        self._y.discard_before(keep_from)
+        self._y_time.discard_before(keep_from)
+        self._coverage.discard_before(self._n_masked - self.span)
+
+        if self._y_time.start < self._y_time.stop and self._whisker_time.start < self._whisker_time.stop:
+            earliest_time = self._y_time[self._y_time.start:self._y_time.start + 1][0]
+            times = self._whisker_time[self._whisker_time.start:self._whisker_time.stop]
+            whisker_keep = self._whisker_time.start + int(np.searchsorted(times, earliest_time, side='left'))
+            whisker_keep -= self.whisker_sampling_rate * self.bsline_length + 1
+            self._whisker_time.discard_before(whisker_keep)
+            self._whisker_velocity.discard_before(whisker_keep)
+
+    def _drain(self):
+        new_events = self._emitted[self._n_drained:]
+        self._n_drained = len(self._emitted)
+        return new_events
+
+def replay_recording(data_folder_path, chunk_seconds=1.0, calibrate=True, bsline_length=5, event_length=15,
+                     threshold_to_exclude_from_min_max=1):
+    # Feeds a recorded cycle through the streaming detector in time order
+    pupil_data = load_pupil_data(data_folder_path)
+    whisker_data = load_whisker_data(data_folder_path)
+    pupil_time, pupil_size = pupil_data['time'].values, pupil_data['pupil_size'].values
+    whisker_time, whisker_angle = whisker_data['time'].values, whisker_data['whisker_angle'].values
+    pupil_sampling_rate = integer_rate(stream_timing(pupil_time))
+    whisker_sampling_rate = integer_rate(stream_timing(whisker_time))
+
+    calibration = None
+    if calibrate:
+        calibration = calibrate_from_recording(pupil_data, whisker_time, whisker_angle, pupil_sampling_rate, threshold_to_exclude_from_min_max)
+
+    detector = StreamingEventDetector(pupil_sampling_rate, whisker_sampling_rate, bsline_length, event_length,
+                                      threshold_to_exclude_from_min_max, calibration)
+    # Shared boundaries so every sample lands in exactly one chunk
+    boundaries = np.arange(chunk_seconds, max(pupil_time[-1], whisker_time[-1]) + chunk_seconds, chunk_seconds)
+    pupil_bounds = np.concatenate([[0], np.searchsorted(pupil_time, boundaries), [pupil_time.shape[0]]])
+    whisker_bounds = np.concatenate([[0], np.searchsorted(whisker_time, boundaries), [whisker_time.shape[0]]])
+    for chunk in range(boundaries.shape[0] + 1):
+        whisker_chunk = slice(whisker_bounds[chunk], whisker_bounds[chunk + 1])
+        pupil_chunk = slice(pupil_bounds[chunk], pupil_bounds[chunk + 1])
+        detector.push_whisker(whisker_time[whisker_chunk], whisker_angle[whisker_chunk])
+        detector.push_pupil(pupil_time[pupil_chunk], pupil_size[pupil_chunk])
+    detector.finish()
+    return detector.events
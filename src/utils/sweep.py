@@ -0,0 +1,173 @@
+# Parameter sweeps over the process_data pipeline. Every stage runs once per distinct
+# combination of the parameters it depends on and is shared by the grid points that agree on them
+import time
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from src.utils.processing import extract_event_windows, exclude_outlier_events
+from src.utils.stages import load_stage, interpolate_stage, whisker_velocity_stage, smooth_stage, detect_stage
+from src.utils.memo import content_key, default_memo_cache, run_stage
+from src.utils.timing import window_sizes
+
+SWEEP_PARAMETERS = (
+    'threshold_to_exclude_from_min_max', 'threshold_to_exclude_base_on_pupil',
+    'bsline_length', 'event_length',
+)
+DEFAULT_PARAMETERS = {
+    'threshold_to_exclude_from_min_max': 1,
+    'threshold_to_exclude_base_on_pupil': 2,
+    'bsline_length': 5,
+    'event_length': 15,
+}
+MODALITIES = ('pupil', 'calcium', 'arteriole', 'whisker')
+
+def expand_grid(grid):
+    # {parameter: value or list of values} -> one parameter dict per grid point
+    unknown = sorted(set(grid) - set(SWEEP_PARAMETERS))
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(unknown)}")
+    values = []
+    for name in SWEEP_PARAMETERS:
+        value = grid.get(name, DEFAULT_PARAMETERS[name])
+        values.append(list(value) if isinstance(value, (list, tuple, np.ndarray)) else [value])
+    return [dict(zip(SWEEP_PARAMETERS, combination)) for combination in itertools.product(*values)]
+
+def response_metrics(windows, sampling_rate, bsline_length):
+    # Mean and peak of the average window after the onset, relative to its baseline
+    if windows.shape[0] == 0:
+        return np.nan, np.nan
+    mean_window = np.nanmean(windows, axis=0)
+    baseline_size = window_sizes(sampling_rate, bsline_length, 0)[0]
+    baseline = np.nanmean(mean_window[:baseline_size])
+    return np.nanmean(mean_window[baseline_size:]) - baseline, np.nanmax(mean_window[baseline_size:]) - baseline
+
+def extract_stage(signals, events, params):
+    # Event counts and per-modality response metrics of one grid point, nothing written to disk
+    bsline_length, event_length = params['bsline_length'], params['event_length']
+    smoothed_time_series = signals['smoothed_time_series']
+    pupil_windows = extract_event_windows(signals['pupil_time'], signals['pupil_size_normalized'], signals['pupil_sampling_rate'],
+                                          smoothed_time_series[events], bsline_length, event_length, normalize=False)
+    pupil_windows, clean_events = exclude_outlier_events(pupil_windows, events, params['threshold_to_exclude_base_on_pupil'])
+    event_times = smoothed_time_series[clean_events]
+
+    windows = {
+        'pupil': (pupil_windows, signals['pupil_sampling_rate']),
+        'calcium': (extract_event_windows(signals['calcium_time'], signals['calcium'], signals['calcium_sampling_rate'], event_times, bsline_length, event_length), signals['calcium_sampling_rate']),
+        'arteriole': (extract_event_windows(signals['arteriole_time'], signals['arteriole_diameter'], signals['arteriole_sampling_rate'], event_times, bsline_length, event_length), signals['arteriole_sampling_rate']),
+        'whisker': (extract_event_windows(signals['whisker_velocity_time'], signals['normalized_whisker_velocity'], signals['whisker_sampling_rate'], event_times, bsline_length, event_length), signals['whisker_sampling_rate']),
+    }
+
+    metrics = {'n_detected': int(events.shape[0]), 'n_events': int(clean_events.shape[0]), 'n_excluded': int(events.shape[0] - clean_events.shape[0])}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for modality in MODALITIES:
+            metrics[f'{modality}_response_mean'], metrics[f'{modality}_response_peak'] = response_metrics(*windows[modality], bsline_length)
+    return metrics
+
+def _extract_signals(loaded, interpolated, whisker, smoothed):
+    # The arrays detection and extract_stage read, as plain numpy so they pickle cheaply to workers
+    return {
+        'normalized_smoothed_pupil_size': smoothed['normalized_smoothed_pupil_size'],
+        'pupil_time': interpolated['pupil_time'],
+        'pupil_size_normalized': smoothed['pupil_size_normalized'],
+        'smoothed_time_series': smoothed['smoothed_time_series'],
+        'calcium_time': loaded['calcium_data']['time'].values,
+        'calcium': loaded['calcium_data']['calcium'].values,
+        'arteriole_time': loaded['arteriole_data']['time'].values,
+        'arteriole_diameter': loaded['arteriole_data']['arteriole_diameter'].values,
+        'whisker_velocity_time': whisker['whisker_velocity_time'],
+        'normalized_whisker_velocity': whisker['normalized_whisker_velocity'],
+        'pupil_sampling_rate': loaded['pupil_sampling_rate'],
+        'calcium_sampling_rate': loaded['calcium_sampling_rate'],
+        'arteriole_sampling_rate': loaded['arteriole_sampling_rate'],
+        'whisker_sampling_rate': loaded['whisker_sampling_rate'],
+    }
+
+# Signals of every (folder, min/max threshold) pair, set once per process by _init_worker so
+# that detection and extraction tasks only carry their key, parameters and events
+_worker_signals = {}
+
+def _init_worker(signals):
+    _worker_signals.update(signals)
+
+def _detect_arguments(signals, bsline_length, event_length):
+    return (signals['normalized_smoothed_pupil_size'], signals['smoothed_time_series'],
+            signals['normalized_whisker_velocity'], signals['whisker_velocity_time'],
+            signals['pupil_sampling_rate'], signals['whisker_sampling_rate'], bsline_length, event_length)
+
+def _detect_task(signal_key, bsline_length, event_length):
+    return detect_stage(*_detect_arguments(_worker_signals[signal_key], bsline_length, event_length))
+
+def _extract_task(signal_key, events, params):
+    return extract_stage(_worker_signals[signal_key], events, params)
+
+def _map(function, argument_lists, executor):
+    if executor is None:
+        return [function(*arguments) for arguments in argument_lists]
+    return list(executor.map(function, *zip(*argument_lists))) if argument_lists else []
+
+def run_sweep(folders, grid, workers=1, use_cache=False, memo=False):
+    # Returns one row per (folder, grid point) with the parameters, event counts and response metrics.
+    # Every stage runs once per distinct setting within the sweep. memo=True or a MemoCache also
+    # reuses stage results across sweeps and with process_data, as in compute_stages
+    grid_points = expand_grid(grid)
+    memo = default_memo_cache() if memo is True else memo
+    start_time = time.perf_counter()
+
+    # Loading and the pupil-independent preprocessing are shared by the whole grid
+    signals = {}
+    thresholds = sorted({params['threshold_to_exclude_from_min_max'] for params in grid_points})
+    for folder in folders:
+        logging.info(f"Preparing sweep stages for folder: {folder}")
+        loaded = load_stage(folder, use_cache)
+        interpolated = run_stage(memo, 'interpolate', interpolate_stage, loaded['pupil_data'])
+        whisker = run_stage(memo, 'whisker_velocity', whisker_velocity_stage, loaded['whisker_angle'], loaded['whisker_time'])
+        for threshold in thresholds:
+            smoothed = run_stage(memo, 'smooth', smooth_stage, interpolated, loaded['pupil_sampling_rate'], threshold)
+            signals[(folder, threshold)] = _extract_signals(loaded, interpolated, whisker, smoothed)
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(signals,))
+    else:
+        executor = None
+        _init_worker(signals)
+    try:
+        # (signal key, bsline_length, event_length) of every distinct detection setting
+        settings = list(dict.fromkeys(((folder, params['threshold_to_exclude_from_min_max']), params['bsline_length'], params['event_length'])
+                                      for folder in folders for params in grid_points))
+        events, pending, memo_keys = {}, [], {}
+        for setting in settings:
+            if memo is None or memo is False:
+                pending.append(setting)
+                continue
+            memo_keys[setting] = content_key('detect', detect_stage, *_detect_arguments(signals[setting[0]], *setting[1:]))
+            cached = memo.get(memo_keys[setting])
+            if cached is None:
+                pending.append(setting)
+            else:
+                events[setting] = cached
+        logging.info(f"Detecting events for {len(pending)} of {len(settings)} distinct detection settings")
+        for setting, setting_events in zip(pending, _map(_detect_task, pending, executor)):
+            events[setting] = setting_events
+            if setting in memo_keys:
+                memo.put(memo_keys[setting], setting_events)
+                memo.misses += 1
+
+        rows, extract_arguments = [], []
+        for folder in folders:
+            for params in grid_points:
+                signal_key = (folder, params['threshold_to_exclude_from_min_max'])
+                extract_arguments.append((signal_key, events[(signal_key, params['bsline_length'], params['event_length'])], params))
+                rows.append({'folder': folder, **params})
+        logging.info(f"Extracting windows for {len(rows)} grid points")
+        for row, metrics in zip(rows, _map(_extract_task, extract_arguments, executor)):
+            row.update(metrics)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _worker_signals.clear()
+
+    logging.info(f"Sweep of {len(grid_points)} grid points over {len(folders)} folders took {time.perf_counter() - start_time:.2f} s")
+    return pd.DataFrame(rows, columns=['folder', *SWEEP_PARAMETERS, 'n_detected', 'n_events', 'n_excluded',
+                                       *[f'{modality}_response_{metric}' for modality in MODALITIES for metric in ('mean', 'peak')]])
@@ -0,0 +1,67 @@
+# Sorted time index of one acquisition stream, answering batched sample lookups with searchsorted
+# instead of a full scan per query, and resampling a stream onto another stream's clock
+import numpy as np
+from src.data.mmap_loader import LinearTimeAxis
+
+RESAMPLE_METHODS = ('linear', 'nearest', 'previous')
+
+class Timebase:
+    def __init__(self, time):
+        # A generated time axis is increasing and searched analytically, never materialized
+        self.time = time if isinstance(time, LinearTimeAxis) else np.asarray(time, dtype=float)
+        self.is_sorted = isinstance(time, LinearTimeAxis) or bool(np.all(self.time[1:] >= self.time[:-1]))
+        # Counting samples before t does not depend on their order, so unsorted streams are searched
+        # through a sorted copy and nearest/previous positions are mapped back with the sort order
+        self._order = None if self.is_sorted else np.argsort(self.time, kind='stable')
+        self._sorted = self.time if self.is_sorted else self.time[self._order]
+
+    def __len__(self):
+        return self.time.shape[0]
+
+    def left_index(self, times):
+        # Number of samples strictly before each time, (self.time < t).sum()
+        return self._sorted.searchsorted(times, side='left')
+
+    def right_index(self, times):
+        # Number of samples at or before each time, (self.time <= t).sum()
+        return self._sorted.searchsorted(times, side='right')
+
+    def nearest_index(self, times):
+        times = np.asarray(times, dtype=float)
+        right = np.clip(self.left_index(times), 1, max(len(self) - 1, 1))
+        left = right - 1
+        positions = np.where(np.abs(times - self._sorted[left]) <= np.abs(self._sorted[right] - times), left, right)
+        positions = np.minimum(positions, len(self) - 1)
+        return positions if self._order is None else self._order[positions]
+
+    def previous_index(self, times):
+        # Last sample at or before each time, the first sample for times before the stream starts
+        positions = np.maximum(self.right_index(times) - 1, 0)
+        return positions if self._order is None else self._order[positions]
+
+    def resample(self, values, target_time, method='linear'):
+        # values sampled on this timebase, evaluated at target_time
+        values = np.asarray(values)
+        if method == 'linear':
+            sorted_values = values if self._order is None else values[self._order]
+            return np.interp(np.asarray(target_time, dtype=float), self._sorted, sorted_values)
+        if method == 'nearest':
+            return values[self.nearest_index(target_time)]
+        if method == 'previous':
+            return values[self.previous_index(target_time)]
+        raise ValueError(f"Unknown resampling method: {method}")
+
+def cycle_timebases(stages):
+    # One Timebase per stream of a cycle, from the output of compute_stages
+    return {
+        'pupil': Timebase(stages['pupil_time']),
+        'smoothed': Timebase(stages['smoothed_time_series']),
+        'whisker': Timebase(stages['whisker_velocity_time']),
+        'calcium': Timebase(stages['calcium_data']['time'].values),
+        'arteriole': Timebase(stages['arteriole_data']['time'].values),
+    }
+
+def align_events(timebases, event_times):
+    # {stream: index of the first sample at or after every event time}, the onset sample the
+    # event windows of each stream start their response at
+    return {name: timebase.left_index(event_times) for name, timebase in timebases.items()}
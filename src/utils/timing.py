@@ -0,0 +1,53 @@
+# Timing metadata of the acquisition streams. Rates come from the median sample interval, which
+# dropped frames and timestamp jitter do not bias the way they bias the mean interval
+import logging
+import numpy as np
+from src.data.mmap_loader import LinearTimeAxis
+
+# Intervals longer than this many median intervals count as dropped frames
+DROP_FACTOR = 1.5
+# Relative interval spread above which a stream is reported as jittery
+JITTER_WARNING = 0.05
+
+def stream_timing(time):
+    if isinstance(time, LinearTimeAxis) and len(time) > 1:
+        # Uniform by construction: the rate is the axis's own, without generating its samples
+        return {'n_samples': len(time), 'start': time.start, 'duration': time[-1] - time.start,
+                'median_interval': time.step, 'rate': time.sampling_rate, 'mean_rate': time.sampling_rate,
+                'jitter': 0.0, 'gaps': 0, 'dropped_frames': 0}
+    time = np.asarray(time, dtype=float)
+    intervals = np.diff(time)
+    median_interval = float(np.median(intervals)) if intervals.shape[0] else np.nan
+    if not median_interval > 0:
+        return {'n_samples': int(time.shape[0]), 'start': float(time[0]) if time.shape[0] else np.nan, 'duration': np.nan,
+                'median_interval': np.nan, 'rate': np.nan, 'mean_rate': np.nan, 'jitter': np.nan, 'gaps': 0, 'dropped_frames': 0}
+
+    gaps = intervals > DROP_FACTOR * median_interval
+    regular = intervals[~gaps]
+    return {
+        'n_samples': int(time.shape[0]),
+        'start': float(time[0]),
+        'duration': float(time[-1] - time[0]),
+        'median_interval': median_interval,
+        'rate': 1 / median_interval,
+        'mean_rate': 1 / float(np.mean(intervals)),
+        'jitter': float(np.std(regular) / median_interval) if regular.shape[0] else 0.0,
+        'gaps': int(gaps.sum()),
+        'dropped_frames': int(np.round(intervals[gaps] / median_interval).sum() - gaps.sum()),
+    }
+
+def integer_rate(timing):
+    # Rate in whole samples per second, as the detection stages index with it
+    return int(round(timing['rate']))
+
+def window_sizes(sampling_rate, bsline_length, event_length):
+    # Baseline and response lengths in samples; exact for integer rates, nearest sample for float rates
+    return int(round(sampling_rate * bsline_length)), int(round(sampling_rate * event_length))
+
+def check_timing(timings):
+    # Logs the streams with dropped frames or irregular sampling
+    for stream, timing in timings.items():
+        if timing['dropped_frames']:
+            logging.warning(f"{stream}: {timing['dropped_frames']} dropped frames in {timing['gaps']} gaps")
+        if timing['jitter'] > JITTER_WARNING:
+            logging.warning(f"{stream}: sample interval jitter is {100 * timing['jitter']:.1f}% of the median interval")
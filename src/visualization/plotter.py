@@ -1,9 +1,9 @@
-import matplotlib.pyplot as plt
-from ipywidgets import interact, FloatSlider
-import numpy as np
-from src.utils.utilities import (detect_sudden_change_events, calculate_properties_possible_events)
+from src.utils.utilities import (detect_sudden_change_events, calculate_properties_possible_events, build_event_mask,
+                                   select_best_candidate)
+from src.utils.timebase import Timebase
 
 def plot_data(data):
+    import matplotlib.pyplot as plt
     plt.plot(data)
     plt.show()
 
@@ -23,15 +23,9 @@ def plot_detected_events(window_size, pre_event_window, pupil_diameter, pupil_ti
         step
     )
 
-    event_or_not = np.zeros(pupil_diameter.shape)
-    for idx, event_idx in enumerate(events_indices):
-        zero_arr = np.zeros(pupil_diameter.shape)
-        if event_idx == 1:
-            zero_arr[step*idx:step*idx+event_window+pre_event_window] = 1
-        elif event_idx == 2:
-            zero_arr[step*idx:step*idx+event_window+pre_event_window] = -1
-        event_or_not += zero_arr
+    event_or_not = build_event_mask(events_indices, pupil_diameter.shape[0], event_window + pre_event_window, step)
 
+    from ipywidgets import interact, FloatSlider
     interact(
         plot_detected_events,
         window_size=FloatSlider(value=1, min=0, max=60, step=1, description='Smoothing'),
@@ -46,7 +40,7 @@ def find_best_events(block, pupil_diameter, time, whisker_time, whisker_velocity
     time_segment = time[block[0]:block[1]]
 
     analysis_results = calculate_properties_possible_events(block, pupil_diameter, time)
-    filtered_results = [res for res in analysis_results if res[4] > res[2] * 3 and res[1] < 0.5 and res[3] - res[1] > 0.2]
+    filtered_results, optimal_event = select_best_candidate(analysis_results)
     if print_result:
         for result in filtered_results:
             print(
@@ -56,6 +50,7 @@ def find_best_events(block, pupil_diameter, time, whisker_time, whisker_velocity
             )
 
     if plot_result:
+        import matplotlib.pyplot as plt
         plt.plot(time_segment, pupil_segment, label='Pupil Segmentation')
         for result in filtered_results:
             plt.axvline(time_segment[result[0]], color='red', linestyle='--')
@@ -64,8 +59,7 @@ def find_best_events(block, pupil_diameter, time, whisker_time, whisker_velocity
         plt.title('Pupil Segmentation Over Time')
         plt.legend()
 
-        start_index = (whisker_time < time_segment[0]).sum()
-        end_index = (whisker_time < time_segment[-1]).sum()
+        start_index, end_index = Timebase(whisker_time).left_index([time_segment[0], time_segment[-1]])
         plt.plot(whisker_time[start_index:end_index], whisker_velocity[start_index:end_index])
         plt.ylim(0, 1)
         plt.xlabel('Time (seconds)')
@@ -73,9 +67,7 @@ def find_best_events(block, pupil_diameter, time, whisker_time, whisker_velocity
         plt.title('Whisker Velocity Over Time')
         plt.show()
 
-    optimal_event = max(filtered_results, key=lambda x: x[6], default=None)
-
-    if plot_result and optimal_event:
+    if plot_result and optimal_event is not None:
         print("\nBest Event:")
         print(
             f"Start index: {optimal_event[0]}, Baseline mean: {optimal_event[1]:.4f}, Baseline std: {optimal_event[2]:.4f}, "
@@ -91,4 +83,4 @@ def find_best_events(block, pupil_diameter, time, whisker_time, whisker_velocity
         plt.legend()
         plt.show()
 
-    return block[0] + optimal_event[0] if optimal_event else None
\ No newline at end of file
+    return int(block[0] + optimal_event['idx']) if optimal_event is not None else None
\ No newline at end of file
@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+import matplotlib.pyplot as plt
+from src.utils.processing import summarize_windows
+from src.utils.results_store import find_results_file, load_results, windows_from_frame, windows_frame
+
+# modality: (windows title, mean title, y label, y scale)
+MODALITY_PLOTS = {
+    'calcium': ("Calcium Data Windows", "Average Calcium Data Window with 95% CI", "Calcium Level", None),
+    'arteriole': ("Arteriole Diameter Data Windows", "Average Arteriole Diameter Data Window with 95% CI", "Arteriole Diameter", None),
+    'whisker': ("Whisker Velocity Data Windows", "Average Whisker Velocity Data Window with 95% CI", "Whisker Velocity", 'log'),
+    'pupil': ("Pupil Size Data Windows", "Average Pupil Size Data Window with 95% CI", "Pupil Size", None),
+}
+TRACE_PLOTS = ('pupil', 'calcium', 'arteriole')
+
+def _finish(figure, show=True, save_path=None):
+    if save_path is not None:
+        figure.savefig(save_path)
+    if show:
+        plt.show()
+    plt.close(figure)
+
+def plot_event_windows(time_event, windows, modality, show=True, save_path=None):
+    title, _, ylabel, yscale = MODALITY_PLOTS[modality]
+    figure = plt.figure()
+    for window in windows:
+        plt.plot(time_event, window)
+    plt.title(title)
+    plt.xlabel("Time (s)")
+    plt.ylabel(ylabel)
+    if yscale:
+        plt.yscale(yscale)
+    _finish(figure, show, save_path)
+
+def plot_mean_with_ci(time_event, mean_window, ci, modality, show=True, save_path=None):
+    _, title, ylabel, yscale = MODALITY_PLOTS[modality]
+    figure = plt.figure()
+    plt.plot(time_event, mean_window, label='Mean')
+    plt.fill_between(time_event, mean_window - ci, mean_window + ci, color='b', alpha=0.2, label='95% CI')
+    plt.title(title)
+    plt.xlabel("Time (s)")
+    plt.ylabel(ylabel)
+    if yscale:
+        plt.yscale(yscale)
+    plt.legend()
+    _finish(figure, show, save_path)
+
+def plot_modality(time_event, windows, modality, mean_window, ci, show=True, save_folder=None):
+    windows_path = None if save_folder is None else os.path.join(save_folder, f'{modality}_windows.png')
+    mean_path = None if save_folder is None else os.path.join(save_folder, f'{modality}_mean.png')
+    plot_event_windows(time_event, windows, modality, show, windows_path)
+    plot_mean_with_ci(time_event, mean_window, ci, modality, show, mean_path)
+
+def save_traces_figure(traces_df, save_path):
+    figure = plt.figure(figsize=(14, 8))
+    for col in traces_df.columns[1:]:
+        plt.plot(traces_df['Time (s)'], traces_df[col], label=col)
+        plt.legend()
+    _finish(figure, show=False, save_path=save_path)
+
+def render_results(results_folder, show=False, save=True, modalities=None):
+    # Rebuild every figure from the results store written by process_data, or from its CSVs
+    store = load_results(results_folder) if find_results_file(results_folder) is not None else None
+    rendered = []
+    for modality in modalities or MODALITY_PLOTS:
+        if store is not None and f'{modality}_windows' in store:
+            time_event, windows = store[f'{modality}_time'], store[f'{modality}_windows']
+        else:
+            windows_file = os.path.join(results_folder, f'{modality}_windows.csv')
+            if not os.path.exists(windows_file):
+                continue
+            time_event, windows = windows_from_frame(pd.read_csv(windows_file))
+        mean_window, ci = summarize_windows(windows)
+        plot_modality(time_event, windows, modality, mean_window, ci, show, results_folder if save else None)
+        if save and modality in TRACE_PLOTS:
+            save_traces_figure(windows_frame(time_event, windows), os.path.join(results_folder, f'{modality}_traces.png'))
+        rendered.append(modality)
+    return rendered
@@ -0,0 +1,43 @@
+import numpy as np
+from src.utils.processing import extract_event_windows, exclude_outlier_events, summarize_windows
+
+RATE = 10
+
+def _trace(duration=60):
+    time = np.arange(duration * RATE) / RATE
+    return time, 100 + np.sin(time)
+
+def test_event_near_the_end_is_padded_and_normalized_on_its_baseline():
+    time, values = _trace()
+    # 5 s baseline inside the recording, only 3 of the 15 s response before its end
+    windows = extract_event_windows(time, values, RATE, [57.0], bsline_length=5, event_length=15)
+    start = int(np.searchsorted(time, 57.0)) - 5 * RATE
+    inside = values[start:]
+    baseline_mean = np.mean(values[start:start + 5 * RATE])
+
+    assert windows.shape == (1, 20 * RATE)
+    np.testing.assert_array_equal(windows[0, :inside.shape[0]], 100 * (inside - baseline_mean) / baseline_mean)
+    assert np.isnan(windows[0, inside.shape[0]:]).all()
+
+def test_partial_baseline_near_the_start_uses_the_recorded_samples():
+    time, values = _trace()
+    windows = extract_event_windows(time, values, RATE, [2.0], bsline_length=5, event_length=15)
+    baseline_mean = np.mean(values[:2 * RATE])
+
+    assert np.isnan(windows[0, :3 * RATE]).all()
+    np.testing.assert_allclose(windows[0, 3 * RATE:], 100 * (values[:17 * RATE] - baseline_mean) / baseline_mean)
+
+def test_padded_windows_are_judged_and_averaged_on_their_recorded_samples():
+    time, values = _trace()
+    windows = extract_event_windows(time, values, RATE, [20.0, 57.0], bsline_length=5, event_length=15, normalize=False)
+    windows = windows - 100
+
+    kept, events = exclude_outlier_events(windows, [200, 570], exclude_threshold=2)
+    np.testing.assert_array_equal(events, [200, 570])
+    # A trace leaving the threshold only inside the recorded part of the end window excludes it
+    windows[1, 6 * RATE:8 * RATE] = 10
+    kept, events = exclude_outlier_events(windows, [200, 570], exclude_threshold=2)
+    np.testing.assert_array_equal(events, [200])
+
+    mean_window, _ = summarize_windows(windows)
+    np.testing.assert_array_equal(mean_window[9 * RATE:], windows[0, 9 * RATE:])